@@ -3,10 +3,15 @@ Functions for calculating and pressure correcting equilibrium constants using th
 
 All functional forms are from Dickson, Sabine and Christian, 2007.
 
-TODO: Think about pH scales!
+Ks are calculated on the Total pH scale, and may be converted to the
+free, seawater or NBS scales with the pH_scale argument of calc_K and
+calc_Ks (see pH_scales.py).
 """
 import numpy as np
-from .coefs import K_coefs, K_presscorr_coefs
+from .coefs import stack_coefficient_sets
+from .approximation_error import calc_approximation_error, ignore_approximation_warning
+from .pH_scales import PH_SCALES, SCALE_DEPENDENT_KS, calc_pH_scale_factors
+from .backend import get_namespace, as_arrays, is_numpy, add_, multiply_, divide_
 from pymyami import calculate_seawater_correction, approximate_seawater_correction
 
 def calc_K1K2(coefficients, temp_c, sal):
@@ -24,14 +29,16 @@ def calc_K1K2(coefficients, temp_c, sal):
     Returns
     -------
     array-like
-        K1 or K2 on XXXXX pH scale.
+        K1 or K2 on Total pH scale.
     """
 
+    xp = get_namespace(temp_c, sal)
+    temp_c, sal = as_arrays(xp, temp_c, sal)
     temp_k = temp_c+273.15
-    return np.power(10, 
+    return 10 ** (
         coefficients[0] +
         coefficients[1] / temp_k +
-        coefficients[2] * np.log(temp_k) +
+        coefficients[2] * xp.log(temp_k) +
         coefficients[3] * sal +
         coefficients[4] * sal * sal
     )
@@ -51,15 +58,17 @@ def calc_KW(coefficients, temp_c, sal):
     Returns
     -------
     array-like
-        KW on XXXXX pH scale.
+        KW on Total pH scale.
     """
 
+    xp = get_namespace(temp_c, sal)
+    temp_c, sal = as_arrays(xp, temp_c, sal)
     temp_k = temp_c+273.15
-    return np.exp(
+    return xp.exp(
         coefficients[0] +
         coefficients[1] / temp_k +
-        coefficients[2] * np.log(temp_k) +
-        + (coefficients[3] / temp_k + coefficients[4] + coefficients[5] * np.log(temp_k)) * np.sqrt(sal) +
+        coefficients[2] * xp.log(temp_k) +
+        + (coefficients[3] / temp_k + coefficients[4] + coefficients[5] * xp.log(temp_k)) * xp.sqrt(sal) +
         coefficients[6] * sal
     )
     
@@ -78,21 +87,23 @@ def calc_KB(coefficients, temp_c, sal):
     Returns
     -------
     array-like
-        KB on XXXXX pH scale.
+        KB on Total pH scale.
     """
 
+    xp = get_namespace(temp_c, sal)
+    temp_c, sal = as_arrays(xp, temp_c, sal)
     temp_k = temp_c+273.15
-    return np.exp(
-        (coefficients[0] + coefficients[1] * np.sqrt(sal) + coefficients[2] * sal) + 
+    return xp.exp(
+        (coefficients[0] + coefficients[1] * xp.sqrt(sal) + coefficients[2] * sal) + 
         (
             coefficients[3] +
-            coefficients[4] * np.sqrt(sal) +
+            coefficients[4] * xp.sqrt(sal) +
             coefficients[5] * sal +
-            coefficients[6] * sal * np.sqrt(sal) +
+            coefficients[6] * sal * xp.sqrt(sal) +
             coefficients[7] * sal * sal
         ) / temp_k +
-        (coefficients[8] + coefficients[9] * np.sqrt(sal) + coefficients[10] * sal) * np.log(temp_k) +
-        coefficients[11] * np.sqrt(sal) * temp_k
+        (coefficients[8] + coefficients[9] * xp.sqrt(sal) + coefficients[10] * sal) * xp.log(temp_k) +
+        coefficients[11] * xp.sqrt(sal) * temp_k
     )
     
 def calc_K0(coefficients, temp_c, sal):
@@ -110,14 +121,16 @@ def calc_K0(coefficients, temp_c, sal):
     Returns
     -------
     array-like
-        K0 on XXXXX pH scale.
+        K0 (independent of pH scale).
     """
 
+    xp = get_namespace(temp_c, sal)
+    temp_c, sal = as_arrays(xp, temp_c, sal)
     temp_k = temp_c+273.15
-    return np.exp(
+    return xp.exp(
         coefficients[0] +
         coefficients[1] * 100 / temp_k +
-        coefficients[2] * np.log(temp_k / 100) +
+        coefficients[2] * xp.log(temp_k / 100) +
         sal * (coefficients[3] + coefficients[4] * temp_k / 100 + coefficients[5] * (temp_k / 100) * (temp_k / 100))
     )
 
@@ -136,20 +149,22 @@ def calc_KS(coefficients, temp_c, sal):
     Returns
     -------
     array-like
-        KS on XXXXX pH scale.
+        KS on free pH scale.
     """
         
+    xp = get_namespace(temp_c, sal)
+    temp_c, sal = as_arrays(xp, temp_c, sal)
     Istr = calc_ionic_strength(sal)
     temp_k = temp_c+273.15
-    return np.exp(
+    return xp.exp(
         coefficients[0]
         + coefficients[1] / temp_k
-        + coefficients[2] * np.log(temp_k)
-        + np.sqrt(Istr) * (coefficients[3] / temp_k + coefficients[4] + coefficients[5] * np.log(temp_k))
-        + Istr * (coefficients[6] / temp_k + coefficients[7] + coefficients[8] * np.log(temp_k))
-        + coefficients[9] / temp_k * Istr * np.sqrt(Istr)
+        + coefficients[2] * xp.log(temp_k)
+        + xp.sqrt(Istr) * (coefficients[3] / temp_k + coefficients[4] + coefficients[5] * xp.log(temp_k))
+        + Istr * (coefficients[6] / temp_k + coefficients[7] + coefficients[8] * xp.log(temp_k))
+        + coefficients[9] / temp_k * Istr * xp.sqrt(Istr)
         + coefficients[10] / temp_k * Istr ** 2
-        + np.log(1 - 0.001005 * sal)
+        + xp.log(1 - 0.001005 * sal)
     )
     
 def calc_Ksp(coefficients, temp_c, sal):
@@ -167,21 +182,22 @@ def calc_Ksp(coefficients, temp_c, sal):
     Returns
     -------
     array-like
-        KspA or KspC on XXXXX pH scale.
+        KspA or KspC (independent of pH scale).
     """
 
+    xp = get_namespace(temp_c, sal)
+    temp_c, sal = as_arrays(xp, temp_c, sal)
     temp_k = temp_c+273.15
-    return np.power(
-        10,
+    return 10 ** (
         (
             coefficients[0] + 
             coefficients[1] * temp_k +
             coefficients[2] / temp_k +
-            coefficients[3] * np.log10(temp_k) +
-            (coefficients[4] + coefficients[5] * temp_k + coefficients[6] / temp_k) * np.sqrt(sal) +
+            coefficients[3] * xp.log10(temp_k) +
+            (coefficients[4] + coefficients[5] * temp_k + coefficients[6] / temp_k) * xp.sqrt(sal) +
             coefficients[7] * sal +
-            coefficients[8] * sal * np.sqrt(sal)
-        ),
+            coefficients[8] * sal * xp.sqrt(sal)
+        )
     )
 
 def calc_KP(coefficients, temp_c, sal):
@@ -199,15 +215,17 @@ def calc_KP(coefficients, temp_c, sal):
     Returns
     -------
     array-like
-        KP1, KP2 or KP3 on XXXXX pH scale.
+        KP1, KP2 or KP3 on Total pH scale.
     """
 
+    xp = get_namespace(temp_c, sal)
+    temp_c, sal = as_arrays(xp, temp_c, sal)
     temp_k = temp_c+273.15
-    return np.exp(
+    return xp.exp(
         coefficients[0] / temp_k
         + coefficients[1]
-        + coefficients[2] * np.log(temp_k)
-        + (coefficients[3] / temp_k + coefficients[4]) * np.sqrt(sal)
+        + coefficients[2] * xp.log(temp_k)
+        + (coefficients[3] / temp_k + coefficients[4]) * xp.sqrt(sal)
         + (coefficients[5] / temp_k + coefficients[6]) * sal
     )
 
@@ -226,14 +244,16 @@ def calc_KP3(coefficients, temp_c, sal):
     Returns
     -------
     array-like
-        KP3 on XXXXX pH scale.
+        KP3 on Total pH scale.
     """
 
+    xp = get_namespace(temp_c, sal)
+    temp_c, sal = as_arrays(xp, temp_c, sal)
     temp_k = temp_c+273.15
-    return np.exp(
+    return xp.exp(
         coefficients[0] / temp_k
         + coefficients[1]
-        + (coefficients[2] / temp_k + coefficients[3]) * np.sqrt(sal)
+        + (coefficients[2] / temp_k + coefficients[3]) * xp.sqrt(sal)
         + (coefficients[4] / temp_k + coefficients[5]) * sal
     )
 
@@ -252,16 +272,18 @@ def calc_KSi(coefficients, temp_c, sal):
     Returns
     -------
     array-like
-        KSi on XXXXX pH scale.
+        KSi on Total pH scale.
     """
 
+    xp = get_namespace(temp_c, sal)
+    temp_c, sal = as_arrays(xp, temp_c, sal)
     Istr = calc_ionic_strength(sal)
     temp_k = temp_c+273.15
 
-    return np.exp(
+    return xp.exp(
         coefficients[0] / temp_k + 
         coefficients[1] +
-        coefficients[2] * np.log(temp_k) +
+        coefficients[2] * xp.log(temp_k) +
         (coefficients[3] / temp_k + coefficients[4]) * Istr ** 0.5 +
         (coefficients[5] / temp_k + coefficients[6]) * Istr +
         (coefficients[7] / temp_k + coefficients[8]) * Istr ** 2
@@ -282,14 +304,16 @@ def calc_KF(coefficients, temp_c, sal):
     Returns
     -------
     array-like
-        KF on XXXXX pH scale.
+        KF on free pH scale.
     """
     
+    xp = get_namespace(temp_c, sal)
+    temp_c, sal = as_arrays(xp, temp_c, sal)
     temp_k = temp_c+273.15
-    return np.exp(
+    return xp.exp(
         coefficients[0] / temp_k + 
         coefficients[1] + 
-        coefficients[2] * np.sqrt(sal)
+        coefficients[2] * xp.sqrt(sal)
     )
 
 K_fns = {
@@ -327,13 +351,15 @@ def calc_pressure_correction(coefficients, p_bar, temp_c):
     sal : array-like
         Salinity
     """
+    xp = get_namespace(p_bar, temp_c)
+    p_bar, temp_c = as_arrays(xp, p_bar, temp_c)
     a0, a1, a2, b0, b1 = coefficients
     dV = a0 + a1 * temp_c + a2 * temp_c ** 2
     dk = (b0 + b1 * temp_c)  # NB: there is a factor of 1000 in CO2sys, which has been incorporated into the coefficients for the function.    
     RT = 83.1451 * (temp_c + 273.15)
-    return np.exp((-dV + 0.5 * dk * p_bar) * p_bar / RT)    
+    return xp.exp((-dV + 0.5 * dk * p_bar) * p_bar / RT)    
 
-def calc_seawater_correction(ks, temp_c, sal, magnesium, calcium, MyAMI_mode='calculate'):
+def calc_seawater_correction(ks, temp_c, sal, magnesium, calcium, MyAMI_mode='calculate', MyAMI_tolerance=0.001):
     """Calculate seawater correction factor for thermodynamic Ks.
 
     Wrapper for pymyami functionality
@@ -351,17 +377,81 @@ def calc_seawater_correction(ks, temp_c, sal, magnesium, calcium, MyAMI_mode='ca
     calcium : array-like
         Calcium concentration in mol/kg
     MyAMI_mode : str
-        Either 'calculate' for full MyAMI or 'approximate' for polynomial approximation
+        Either 'calculate' for full MyAMI, 'approximate' for polynomial
+        approximation, or 'auto' to use the polynomial approximation
+        only where its tabulated error is below MyAMI_tolerance for all
+        of the Ks, and full MyAMI elsewhere.
+    MyAMI_tolerance : float
+        Maximum relative error of the seawater correction accepted from
+        the polynomial approximation in 'auto' mode.
     """
+    if isinstance(ks, str):
+        ks = [ks]
+
     if MyAMI_mode == 'calculate':
         seawater_correction = calculate_seawater_correction(Sal=sal, TempC=temp_c, Mg=magnesium, Ca=calcium)
     elif MyAMI_mode == 'approximate':
         seawater_correction = approximate_seawater_correction(Sal=sal, TempC=temp_c, Mg=magnesium, Ca=calcium)
+    elif MyAMI_mode == 'auto':
+        seawater_correction = auto_seawater_correction(ks, temp_c=temp_c, sal=sal, magnesium=magnesium, calcium=calcium, tolerance=MyAMI_tolerance)
     else:
-        raise(ValueError("Unknown MyAMI_mode - must be 'calculate' or 'approximate'"))
+        raise(ValueError("Unknown MyAMI_mode - must be 'calculate', 'approximate' or 'auto'"))
     
     return {name:seawater_correction[name] for name in ks if name in seawater_correction}
 
+def auto_seawater_correction(ks, temp_c, sal, magnesium, calcium, tolerance=0.001):
+    """Calculate seawater correction, approximating it where this is accurate.
+
+    Points inside the domain of the polynomial approximation where the
+    tabulated approximation error (see approximation_error.py) of all
+    the Ks is below tolerance use approximate_seawater_correction. All
+    other points use calculate_seawater_correction.
+
+    Parameters
+    ----------
+    ks : array-like
+        list of strings for names of K's
+    temp_c : array-like
+        Temperature in Celcius
+    sal : array-like
+        Salinity
+    magnesium : array-like
+        Magnesium concentration in mol/kg
+    calcium : array-like
+        Calcium concentration in mol/kg
+    tolerance : float
+        Maximum relative error accepted from the approximation.
+
+    Returns
+    -------
+    dict
+        Containing seawater correction factors for the specified inputs
+    """
+    if magnesium is None:
+        magnesium = 0.0528171
+    if calcium is None:
+        calcium = 0.0102821
+    temp_c, sal, magnesium, calcium = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (temp_c, sal, magnesium, calcium)])
+
+    approximate = calc_approximation_error(ks, temp_c=temp_c, sal=sal, magnesium=magnesium, calcium=calcium) <= tolerance
+    calculate = ~approximate
+
+    seawater_correction = {}
+    for mask in (approximate, calculate):
+        if not np.any(mask):
+            continue
+        if mask is approximate:
+            with ignore_approximation_warning():  # the approximation is known to be within tolerance
+                correction = approximate_seawater_correction(Sal=sal[mask], TempC=temp_c[mask], Mg=magnesium[mask], Ca=calcium[mask])
+        else:
+            correction = calculate_seawater_correction(Sal=sal[mask], TempC=temp_c[mask], Mg=magnesium[mask], Ca=calcium[mask])
+        for name, v in correction.items():
+            if name not in seawater_correction:
+                seawater_correction[name] = np.ones(temp_c.shape)
+            seawater_correction[name][mask] = v
+
+    return seawater_correction
+
 def calc_ionic_strength(sal):
     # Ionic strength after Dickson 1990a; see Dickson et al 2007
     return 19.924 * sal / (1000 - 1.005 * sal)
@@ -384,12 +474,13 @@ def calc_fluorine(sal):
     """
     return 6.7e-5 * sal / 1.80655 / 18.9984 # mol/kg-SW
 
-def calc_K(K, temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0528171, calcium=0.0102821, sulphate=None, fluorine=None, MyAMI_mode='calculate'):
+def calc_K(K, temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0528171, calcium=0.0102821, sulphate=None, fluorine=None, MyAMI_mode='calculate', MyAMI_tolerance=0.001, pH_scale='total', coefficient_sets=None):
     """
     Calculate a specified stoichiometric equilibrium constant at given
     temperature, salinity and pressure.
 
-    TODO: document pH scales.
+    Ks are calculated on the Total pH scale, and converted to the
+    requested pH_scale using KS and KF at the given conditions.
 
     Parameters
     ----------
@@ -420,11 +511,25 @@ def calc_K(K, temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0528171, calcium=0.0
         Total fluorine in mol/kgsw. Calculated from salinity if not
         given.
     MyAMI_mode : str
-        Either 'calculate' or 'approximate'. In the former case,
+        Either 'calculate', 'approximate' or 'auto'. In the first case,
         the full MyAMI model is run to calculate the correction
-        factor for the Ks. In the latter, a polynomial function is
-        used to approximate the correction factor. The latter is faster,
-        though marginally less accurate.
+        factor for the Ks. In the second, a polynomial function is
+        used to approximate the correction factor. This is faster,
+        though marginally less accurate. In 'auto' mode the polynomial
+        is used only where its error is known to be below
+        MyAMI_tolerance, and the full MyAMI model elsewhere.
+    MyAMI_tolerance : float
+        Maximum relative error in the seawater correction accepted
+        from the polynomial approximation in 'auto' mode.
+    pH_scale : str
+        pH scale of the returned Ks. One of 'total', 'free', 'seawater'
+        or 'NBS'. K0, KspA, KspC, KS and KF are not affected.
+    coefficient_sets : str or list of str
+        Name of a coefficient set registered with
+        kgen.coefs.register_coefficient_set, or a list of names to
+        evaluate them all in one pass. Each K then has a leading axis of
+        length n_sets, in the order given. The default coefficients if
+        None.
 
     Returns
     -------
@@ -434,44 +539,15 @@ def calc_K(K, temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0528171, calcium=0.0
     if K not in K_fns:
         raise ValueError(f'{K} is not valid. Should be one of {K_fns.keys}')
 
-    if temp_c is None:
-        temp_c = 25.0
-    if sal is None:
-        sal = 35.0    
-    if p_bar is None:
-        p_bar = 0.0
+    return calc_Ks(K_list=[K], temp_c=temp_c, sal=sal, p_bar=p_bar, magnesium=magnesium, calcium=calcium, sulphate=sulphate, fluorine=fluorine, MyAMI_mode=MyAMI_mode, MyAMI_tolerance=MyAMI_tolerance, pH_scale=pH_scale, coefficient_sets=coefficient_sets)[K]
 
-    if fluorine is None:
-        fluorine = calc_fluorine(sal=sal)
-    if sulphate is None:
-        sulphate = calc_sulphate(sal=sal)
-        
-    K_calc = K_fns[K](coefficients=K_coefs[K], temp_c=temp_c, sal=sal)
-
-    if np.any(p_bar != 0.0):
-        KS_surf = K_fns['KS'](coefficients=K_coefs['KS'], temp_c=temp_c, sal=sal)
-        KS_deep = KS_surf * calc_pressure_correction(coefficients=K_presscorr_coefs['KS'], p_bar=p_bar, temp_c=temp_c)
-        KF_surf = K_fns['KF'](coefficients=K_coefs['KF'], temp_c=temp_c, sal=sal)
-        KF_deep = KF_surf * calc_pressure_correction(coefficients=K_presscorr_coefs['KF'], p_bar=p_bar, temp_c=temp_c)
-        
-        tot_to_sws_surface = (1 + sulphate / KS_surf + fluorine / KF_surf) / (1 + sulphate / KS_surf)  # convert from TOT to SWS before pressure correction
-        sws_to_tot_deep = (1 + sulphate / KS_deep) / (1 + sulphate / KS_deep + fluorine / KF_deep)  # convert from SWS to TOT after pressure correction
-        
-        K_calc *= tot_to_sws_surface * calc_pressure_correction(coefficients=K_presscorr_coefs[K], p_bar=p_bar, temp_c=temp_c) * sws_to_tot_deep
-
-    if np.any(calcium != 0.0102821) or np.any(magnesium != 0.0528171):
-        seawater_corrections = calc_seawater_correction(K, temp_c=temp_c, sal=sal, magnesium=magnesium, calcium=calcium, MyAMI_mode=MyAMI_mode)
-        if K in seawater_corrections:
-            K_calc *= seawater_corrections[K]
-    
-    return K_calc
-
-def calc_Ks(K_list=K_fns.keys(), temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0528171, calcium=0.0102821, sulphate=None, fluorine=None, MyAMI_mode='calculate'):
+def calc_Ks(K_list=K_fns.keys(), temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0528171, calcium=0.0102821, sulphate=None, fluorine=None, MyAMI_mode='calculate', MyAMI_tolerance=0.001, pH_scale='total', coefficient_sets=None, max_memory=None):
     """
     Calculate specified stoichiometric equilibrium constants at given
     temperature, salinity and pressure.
 
-    TODO: document pH scales.
+    Ks are calculated on the Total pH scale, and converted to the
+    requested pH_scale using KS and KF at the given conditions.
 
     Parameters
     ----------
@@ -502,54 +578,215 @@ def calc_Ks(K_list=K_fns.keys(), temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0
         Total fluorine in mol/kgsw. Calculated from salinity if not
         given.
     MyAMI_mode : str
-        Either 'calculate' or 'approximate'. In the former case,
+        Either 'calculate', 'approximate' or 'auto'. In the first case,
         the full MyAMI model is run to calculate the correction
-        factor for the Ks. In the latter, a polynomial function is
-        used to approximate the correction factor. The latter is faster,
-        though marginally less accurate.
+        factor for the Ks. In the second, a polynomial function is
+        used to approximate the correction factor. This is faster,
+        though marginally less accurate. In 'auto' mode the polynomial
+        is used only where its error is known to be below
+        MyAMI_tolerance, and the full MyAMI model elsewhere.
+    MyAMI_tolerance : float
+        Maximum relative error in the seawater correction accepted
+        from the polynomial approximation in 'auto' mode.
+    pH_scale : str
+        pH scale of the returned Ks. One of 'total', 'free', 'seawater'
+        or 'NBS'. K0, KspA, KspC, KS and KF are not affected.
+    coefficient_sets : str or list of str
+        Name of a coefficient set registered with
+        kgen.coefs.register_coefficient_set, or a list of names to
+        evaluate them all in one pass. Each K then has a leading axis of
+        length n_sets, in the order given. The default coefficients if
+        None.
+    max_memory : int
+        Approximate limit in bytes on the memory used by the calculation,
+        including the returned Ks but not the inputs. If the inputs are
+        too large, they are processed in chunks to stay within it. Only
+        available for NumPy inputs.
 
     Returns
     -------
     dict
-        Containing calculated Ks.
+        Containing calculated Ks. With a list of coefficient_sets, each
+        has shape (n_sets,) + the broadcast shape of the inputs.
     """
     if K_list is None:
         K_list = K_fns.keys()
 
+    inputs, options = _calc_Ks_arguments(temp_c=temp_c, sal=sal, p_bar=p_bar, magnesium=magnesium, calcium=calcium, sulphate=sulphate, fluorine=fluorine, MyAMI_mode=MyAMI_mode, MyAMI_tolerance=MyAMI_tolerance, pH_scale=pH_scale, coefficient_sets=coefficient_sets)
+
+    if max_memory is not None:
+        if not is_numpy(options['xp']):
+            raise ValueError('max_memory is only available for NumPy inputs')
+        return _calc_Ks_chunked(list(K_list), inputs, options, max_memory)
+
+    return _calc_Ks(K_list, **inputs, **options)
+
+def _needs_seawater_correction(magnesium, calcium):
+    # Whether any magnesium or calcium differs from modern seawater
+    return bool(np.any(np.asarray(calcium) != 0.0102821) or np.any(np.asarray(magnesium) != 0.0528171))
+
+def _needs_pressure_correction(p_bar):
+    # Pressure arrays from other backends may not be inspectable (e.g. inside jax.jit), so the
+    # correction is always applied to them.
+    if is_numpy(get_namespace(p_bar)):
+        return bool(np.any(p_bar != 0.0))
+    return True
+
+def _calc_Ks_arguments(temp_c, sal, p_bar, magnesium, calcium, sulphate, fluorine, MyAMI_mode, MyAMI_tolerance, pH_scale, coefficient_sets, seawater=None, pressure=None):
+    # Check the arguments of calc_Ks and fill in defaults, returning the
+    # inputs and options for _calc_Ks. Whether the seawater and pressure
+    # corrections are needed is decided from these inputs unless given, so
+    # that callers working through a dataset in parts can decide it once
+    # for the whole dataset, and get the same results as calc_Ks.
     if temp_c is None:
         temp_c = 25.0
     if sal is None:
-        sal = 35.0    
+        sal = 35.0
     if p_bar is None:
         p_bar = 0.0
-    
-    if fluorine is None:
-        fluorine = calc_fluorine(sal=sal)
-    if sulphate is None:
-        sulphate = calc_sulphate(sal=sal)
 
-    if np.any(calcium != 0.0102821) or np.any(magnesium != 0.0528171):
-        seawater_corrections = calc_seawater_correction(K_list, temp_c=temp_c, sal=sal, magnesium=magnesium, calcium=calcium, MyAMI_mode=MyAMI_mode)
+    if pH_scale not in PH_SCALES:
+        raise ValueError(f"Unknown pH_scale '{pH_scale}' - must be one of {PH_SCALES}")
+
+    # A list of coefficient sets is evaluated as an ensemble, along a new leading axis
+    ensemble = coefficient_sets is not None and not isinstance(coefficient_sets, str)
+    if coefficient_sets is None:
+        coefficient_sets = ['default']
+    elif not ensemble:
+        coefficient_sets = [coefficient_sets]
+    coefficient_sets = list(coefficient_sets)
+    if len(coefficient_sets) == 0:
+        raise ValueError('coefficient_sets must contain at least one set')
+
+    # MyAMI runs on NumPy, so magnesium and calcium must be concrete values
+    # for any array backend. The corrections are converted back afterwards.
+    xp = get_namespace(temp_c, sal, p_bar, sulphate, fluorine)
+    if seawater is None:
+        seawater = _needs_seawater_correction(magnesium, calcium)
+    if pressure is None:
+        pressure = _needs_pressure_correction(p_bar)
+
+    inputs = {'temp_c': temp_c, 'sal': sal, 'p_bar': p_bar, 'magnesium': magnesium, 'calcium': calcium, 'sulphate': sulphate, 'fluorine': fluorine}
+    options = {'MyAMI_mode': MyAMI_mode, 'MyAMI_tolerance': MyAMI_tolerance, 'pH_scale': pH_scale, 'pressure': pressure, 'seawater': seawater, 'coefficient_sets': coefficient_sets, 'ensemble': ensemble, 'xp': xp}
+    return inputs, options
+
+# Approximate memory used by _calc_Ks in addition to the returned Ks, as
+# (fixed bytes, point-sized float arrays), by MyAMI_mode (None when no
+# seawater correction is needed). These are upper bounds measured with
+# tracemalloc for pymyami 2.1.0 (the pinned version), whose MyAMI
+# calculation dominates whenever it runs. Re-measure them when pymyami
+# is updated.
+_MEMORY_USE = {
+    None: (2**14, 14),
+    'approximate': (2**19, 75),
+    'calculate': (2**19, 1200),
+    'auto': (2**19, 1200),
+}
+
+def _calc_Ks_chunked(K_list, inputs, options, max_memory):
+    # Evaluate _calc_Ks in chunks of the flattened inputs, so that the
+    # memory used stays below max_memory.
+    shape = np.broadcast_shapes(*[np.shape(v) for v in inputs.values() if v is not None])
+    size = int(np.prod(shape))
+    itemsize = np.dtype(float).itemsize
+    fixed, scratch = _MEMORY_USE.get(options['MyAMI_mode'] if options['seawater'] else None, _MEMORY_USE['calculate'])
+    max_memory -= fixed
+
+    # an ensemble holds every K, and the K scratch arrays, once per set
+    sets = (len(options['coefficient_sets']),) if options['ensemble'] else ()
+    n_Ks = len(K_list) * int(np.prod(sets))
+    scratch += _MEMORY_USE[None][1] * (int(np.prod(sets)) - 1)
+
+    if size * itemsize * (n_Ks + scratch) <= max_memory:
+        return _calc_Ks(K_list, **inputs, **options)
+
+    # each chunk holds copies of the array inputs, its own Ks and scratch arrays
+    array_inputs = [k for k, v in inputs.items() if np.ndim(v) > 0]
+    chunk_size = (max_memory - size * itemsize * n_Ks) // (itemsize * (len(array_inputs) + n_Ks + scratch))
+    if chunk_size < 1:
+        raise ValueError(f'max_memory is too small to hold the calculated Ks ({size * itemsize * n_Ks} bytes)')
+
+    Ks = {}
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        chunk = dict(inputs)
+        for k in array_inputs:
+            chunk[k] = np.broadcast_to(inputs[k], shape).flat[start:stop]
+        chunk_Ks = _calc_Ks(K_list, **chunk, **options)
+        for k in K_list:
+            if k not in Ks:
+                # Ks that do not depend on any array input stay scalar, as in _calc_Ks
+                Ks[k] = chunk_Ks[k] if np.ndim(chunk_Ks[k]) == len(sets) else np.empty(sets + shape, dtype=chunk_Ks[k].dtype)
+            if np.ndim(Ks[k]) > len(sets):
+                Ks[k].reshape(sets + (-1,))[..., start:stop] = chunk_Ks[k]
+        del chunk_Ks  # release this chunk before calculating the next
+    return Ks
+
+def _tot_to_sws(KS, KF, sulphate, fluorine):
+    # Factor converting Ks from the Total to the seawater scale
+    free_to_tot = add_(sulphate / KS, 1)
+    return divide_(add_(fluorine / KF, free_to_tot), free_to_tot)
+
+def _calc_Ks(K_list, temp_c, sal, p_bar, magnesium, calcium, sulphate, fluorine, MyAMI_mode, MyAMI_tolerance, pH_scale, pressure, seawater, coefficient_sets, ensemble, xp):
+    # Calculate Ks as in calc_Ks, where whether the pressure and seawater
+    # corrections are needed has already been decided for all the inputs.
+    # Every K is corrected in place, and corrections are released as soon
+    # as they have been applied, to keep the memory used small.
+
+    # Coefficients that differ between sets broadcast along a leading axis,
+    # so everything that only depends on the inputs (including shared
+    # coefficients) is calculated once for all the sets.
+    shape = np.broadcast_shapes(*[np.shape(v) for v in (temp_c, sal, p_bar, magnesium, calcium, sulphate, fluorine) if v is not None])
+    K_coefs, K_presscorr_coefs = stack_coefficient_sets(coefficient_sets, ndim=len(shape))
+    if not is_numpy(xp):
+        K_coefs, K_presscorr_coefs = [{k: v if isinstance(v, list) else xp.asarray(v) for k, v in coefs.items()} for coefs in (K_coefs, K_presscorr_coefs)]
+
+    if seawater:
+        seawater_corrections = calc_seawater_correction(K_list, temp_c=np.asarray(temp_c), sal=np.asarray(sal), magnesium=magnesium, calcium=calcium, MyAMI_mode=MyAMI_mode, MyAMI_tolerance=MyAMI_tolerance)
+        seawater_corrections = {k: xp.asarray(v) if not is_numpy(xp) else v for k, v in seawater_corrections.items()}
     else:
         seawater_corrections = {}
 
+    # KS and KF are calculated once, and shared by the pressure correction and pH scale conversion.
+    if pressure or pH_scale != 'total':
+        if fluorine is None:
+            fluorine = calc_fluorine(sal=sal)
+        if sulphate is None:
+            sulphate = calc_sulphate(sal=sal)
+        KS = K_fns['KS'](coefficients=K_coefs['KS'], temp_c=temp_c, sal=sal)
+        KF = K_fns['KF'](coefficients=K_coefs['KF'], temp_c=temp_c, sal=sal)
+
+    if pressure:
+        # convert from TOT to SWS before pressure correction, and from SWS to TOT after
+        sws_correction = _tot_to_sws(KS, KF, sulphate, fluorine)
+        KS = multiply_(KS, calc_pressure_correction(coefficients=K_presscorr_coefs['KS'], p_bar=p_bar, temp_c=temp_c))
+        KF = multiply_(KF, calc_pressure_correction(coefficients=K_presscorr_coefs['KF'], p_bar=p_bar, temp_c=temp_c))
+        sws_correction = divide_(sws_correction, _tot_to_sws(KS, KF, sulphate, fluorine))
+
     Ks = {}
     for k in K_list:
-        Ks[k] = K_fns[k](coefficients=K_coefs[k], temp_c=temp_c, sal=sal)
-        
-        if np.any(p_bar != 0.0):
-            KS_surf = K_fns['KS'](coefficients=K_coefs['KS'], temp_c=temp_c, sal=sal)
-            KS_deep = KS_surf * calc_pressure_correction(coefficients=K_presscorr_coefs['KS'], p_bar=p_bar, temp_c=temp_c)
-            KF_surf = K_fns['KF'](coefficients=K_coefs['KF'], temp_c=temp_c, sal=sal)
-            KF_deep = KF_surf * calc_pressure_correction(coefficients=K_presscorr_coefs['KF'], p_bar=p_bar, temp_c=temp_c)
-            
-            tot_to_sws_surface = (1 + sulphate / KS_surf + fluorine / KF_surf) / (1 + sulphate / KS_surf)  # convert from TOT to SWS before pressure correction
-            sws_to_tot_deep = (1 + sulphate / KS_deep) / (1 + sulphate / KS_deep + fluorine / KF_deep)  # convert from SWS to TOT after pressure correction
+        K = K_fns[k](coefficients=K_coefs[k], temp_c=temp_c, sal=sal)
+
+        if pressure and k in K_presscorr_coefs:
+            K = multiply_(K, sws_correction)
+            K = multiply_(K, calc_pressure_correction(coefficients=K_presscorr_coefs[k], p_bar=p_bar, temp_c=temp_c))
 
-            if k in K_presscorr_coefs:
-                Ks[k] *= tot_to_sws_surface * calc_pressure_correction(coefficients=K_presscorr_coefs[k], p_bar=p_bar, temp_c=temp_c) * sws_to_tot_deep                
-        
         if k in seawater_corrections:
-            Ks[k] *= seawater_corrections[k]            
-    
-    return Ks
\ No newline at end of file
+            K = multiply_(K, seawater_corrections.pop(k))
+
+        Ks[k] = K
+
+    if pH_scale != 'total':
+        factor = calc_pH_scale_factors(KS=KS, KF=KF, sulphate=sulphate, fluorine=fluorine, temp_c=temp_c, sal=sal)[pH_scale]
+        for k in Ks:
+            if k in SCALE_DEPENDENT_KS:
+                Ks[k] = multiply_(Ks[k], factor)
+
+    if ensemble:
+        # Ks that are the same for every set are copied along the leading axis
+        ensemble_shape = (len(coefficient_sets),) + shape
+        for k in Ks:
+            if tuple(np.shape(Ks[k])) != ensemble_shape:
+                Ks[k] = np.array(np.broadcast_to(Ks[k], ensemble_shape)) if is_numpy(xp) else xp.broadcast_to(Ks[k], ensemble_shape)
+
+    return Ks
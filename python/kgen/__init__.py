@@ -1,4 +1,8 @@
 from .K_functions import calc_K, calc_Ks
+from .out_of_core import calc_Ks_memmap
+from .derivatives import calc_Ks_jacobian
+from .carbonate import calc_carbonate_system
+from .surrogate import fit_surrogate, load_surrogate
 
 VERSION = "0.3.2"
 
@@ -0,0 +1,163 @@
+"""
+Characterisation of the error in the polynomial approximation of MyAMI.
+
+The error of approximate_seawater_correction relative to the full
+calculate_seawater_correction is not uniform across (T, S, Mg, Ca). The
+maximum relative error of each seawater correction factor is tabulated on
+a regular grid of cells covering the domain of the approximation, and
+stored in 'MyAMI_approximation_error.json'. This is used by the 'auto'
+MyAMI_mode to decide which points may be approximated.
+"""
+import os
+import json
+import warnings
+import threading
+from contextlib import contextmanager
+import numpy as np
+import pkg_resources as pkgrs
+from pymyami import calculate_seawater_correction, approximate_seawater_correction
+
+error_path = pkgrs.resource_filename('kgen', 'MyAMI_approximation_error.json')
+
+# domain of the polynomial approximation, from pymyami.approximate.check_limits
+DOMAIN = {
+    'temp_c': (0., 40.),
+    'sal': (30., 40.),
+    'magnesium': (0., 0.06),
+    'calcium': (0., 0.06),
+}
+
+# warnings.catch_warnings changes the filters of the whole process, and
+# concurrent uses can leave them changed, so kgen's uses are serialised.
+_warnings_lock = threading.Lock()
+
+@contextmanager
+def ignore_approximation_warning():
+    """Silence pymyami's warning that the MyAMI approximation is in use.
+
+    For use where the error of the approximation is known. Only that
+    warning is ignored, and only one thread at a time changes the warning
+    filters, so this is safe to use from threads (e.g. in
+    calc_Ks_montecarlo).
+    """
+    with _warnings_lock, warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='WARNING: using approximate MyAMI', category=UserWarning)
+        yield
+
+def generate_approximation_error(n_cells=(8, 4, 6, 6), n_sub=5, path=None):
+    """Tabulate the maximum relative error of the MyAMI approximation.
+
+    The domain is divided into a grid of cells, and both the full and
+    approximate seawater corrections are evaluated at n_sub points along
+    each edge of each cell (including the cell corners). The maximum
+    absolute relative error within each cell is saved for each K.
+
+    Parameters
+    ----------
+    n_cells : tuple of int
+        Number of cells along the temp_c, sal, magnesium and calcium axes.
+    n_sub : int
+        Number of points sampled along each edge of each cell.
+    path : str
+        File to save the table to. Defaults to the packaged table.
+
+    Returns
+    -------
+    dict
+        The saved table.
+    """
+    if path is None:
+        path = error_path
+
+    edges = [np.linspace(*DOMAIN[k], n + 1) for k, n in zip(DOMAIN, n_cells)]
+    fine = [np.linspace(*DOMAIN[k], n * (n_sub - 1) + 1) for k, n in zip(DOMAIN, n_cells)]
+    temp_c, sal, magnesium, calcium = np.meshgrid(*fine, indexing='ij')
+
+    calculated = calculate_seawater_correction(Sal=sal, TempC=temp_c, Mg=magnesium, Ca=calcium)
+    with ignore_approximation_warning():
+        approximated = approximate_seawater_correction(Sal=sal, TempC=temp_c, Mg=magnesium, Ca=calcium)
+
+    errors = {}
+    for k in calculated:
+        err = np.abs(approximated[k] / calculated[k] - 1)
+        # maximum over the points belonging to each cell, one axis at a time
+        for axis, n in enumerate(n_cells):
+            err = np.max([np.take(err, np.arange(o, o + n * (n_sub - 1), n_sub - 1), axis=axis) for o in range(n_sub)], axis=0)
+        errors[k] = [float(f'{e:.3g}') for e in err.ravel()]
+
+    table = {
+        'info': f'Maximum absolute relative error of pymyami.approximate_seawater_correction vs. calculate_seawater_correction within each cell, sampled at {n_sub} points along each cell edge. Errors are in C order over (temp_c, sal, magnesium, calcium) cells.',
+        'edges': {k: list(e) for k, e in zip(DOMAIN, edges)},
+        'errors': errors,
+    }
+
+    with open(path, 'w') as f:
+        json.dump(table, f)
+
+    return table
+
+def load_approximation_error(path=None):
+    """Load a table of MyAMI approximation errors.
+
+    Parameters
+    ----------
+    path : str
+        File to load. Defaults to the packaged table.
+
+    Returns
+    -------
+    edges : list of array-like
+        Cell edges for temp_c, sal, magnesium and calcium.
+    errors : dict
+        Maximum relative error within each cell for each K.
+    """
+    if path is None:
+        path = error_path
+
+    with open(path, 'r') as f:
+        table = json.load(f)
+
+    edges = [np.array(table['edges'][k]) for k in DOMAIN]
+    shape = tuple(len(e) - 1 for e in edges)
+    errors = {k: np.reshape(v, shape) for k, v in table['errors'].items()}
+    return edges, errors
+
+approximation_edges, approximation_errors = load_approximation_error() if os.path.exists(error_path) else (None, {})
+
+def calc_approximation_error(ks, temp_c, sal, magnesium, calcium):
+    """Look up the maximum error of the MyAMI approximation at given conditions.
+
+    Parameters
+    ----------
+    ks : array-like
+        list of strings for names of K's
+    temp_c : array-like
+        Temperature in Celcius
+    sal : array-like
+        Salinity
+    magnesium : array-like
+        Magnesium concentration in mol/kg
+    calcium : array-like
+        Calcium concentration in mol/kg
+
+    Returns
+    -------
+    array-like
+        The largest tabulated relative error of any of the specified Ks
+        at each point. Points outside the domain of the approximation
+        are given an error of inf.
+    """
+    temp_c, sal, magnesium, calcium = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (temp_c, sal, magnesium, calcium)])
+
+    index = []
+    inside = np.ones(temp_c.shape, dtype=bool)
+    for x, e in zip((temp_c, sal, magnesium, calcium), approximation_edges):
+        inside &= (x >= e[0]) & (x <= e[-1])
+        index.append(np.clip(np.searchsorted(e, x, side='right') - 1, 0, len(e) - 2))
+
+    error = np.zeros(temp_c.shape)
+    for k in ks:
+        if k in approximation_errors:
+            error = np.maximum(error, approximation_errors[k][tuple(index)])
+
+    return np.where(inside, error, np.inf)
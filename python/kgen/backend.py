@@ -0,0 +1,92 @@
+"""
+Array backend selection, so that Ks can be calculated with NumPy, JAX or PyTorch arrays.
+
+The K functions look up the array namespace of their inputs following the
+Python array API standard. NumPy arrays and Python scalars always use
+NumPy itself, so results are unchanged for NumPy users. Other array
+libraries are supported via the optional array-api-compat package.
+"""
+import numpy as np
+
+try:
+    from array_api_compat import array_namespace
+except ImportError:
+    array_namespace = None
+
+_NUMPY_TYPES = (int, float, np.ndarray, np.generic)
+
+def get_namespace(*xs):
+    """Get the array namespace of the given inputs.
+
+    Parameters
+    ----------
+    *xs : array-like or scalar
+        Inputs. None values are ignored.
+
+    Returns
+    -------
+    module
+        NumPy if all inputs are Python scalars or NumPy arrays, otherwise
+        the array API namespace of the non-NumPy inputs.
+    """
+    arrays = [x for x in xs if x is not None and not isinstance(x, _NUMPY_TYPES)]
+    if not arrays:
+        return np
+    if array_namespace is not None:
+        return array_namespace(*arrays)
+    if hasattr(arrays[0], '__array_namespace__'):
+        return arrays[0].__array_namespace__()
+    raise TypeError(f'Unsupported array type {type(arrays[0])} - install array-api-compat to use kgen with this array library.')
+
+def as_arrays(xp, *xs):
+    """Convert inputs to arrays of namespace xp.
+
+    Inputs are returned unchanged for NumPy. Otherwise Python scalars take
+    the floating point dtype of the array inputs, as some libraries
+    (e.g. PyTorch) would otherwise make them single precision.
+    """
+    if xp is np:
+        return xs
+    xs = [x if x is None or isinstance(x, (int, float)) else xp.asarray(x) for x in xs]
+    dtypes = [x.dtype for x in xs if x is not None and not isinstance(x, (int, float))]
+    dtype = next((d for d in dtypes if xp.isdtype(d, 'real floating')), xp.float64)
+    return tuple(xp.asarray(x, dtype=dtype) if isinstance(x, (int, float)) else x for x in xs)
+
+def is_numpy(xp):
+    """Whether xp is NumPy, where Python control flow on array values is allowed."""
+    return xp is np
+
+def _inplace(x, y):
+    # x can be updated in place if it is a floating point NumPy array that y
+    # does not broadcast beyond or promote to a different dtype.
+    return (
+        isinstance(x, np.ndarray) and x.dtype.kind == 'f' and x.flags.writeable
+        and np.broadcast_shapes(x.shape, np.shape(y)) == x.shape
+        and np.result_type(x, y) == x.dtype
+    )
+
+def add_(x, y):
+    """x + y, written into x if it is a NumPy array.
+
+    Only use on intermediate arrays created within a function, never on
+    inputs. Other namespaces are never modified in place, so that
+    autograd graphs stay valid.
+    """
+    if _inplace(x, y):
+        x += y
+        return x
+    return x + y
+
+def multiply_(x, y):
+    """x * y, written into x if it is a NumPy array (see add_)."""
+    if _inplace(x, y):
+        x *= y
+        return x
+    return x * y
+
+def divide_(x, y):
+    """x / y, written into x if it is a NumPy array (see add_)."""
+    if _inplace(x, y):
+        x /= y
+        return x
+    return x / y
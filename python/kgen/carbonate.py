@@ -0,0 +1,215 @@
+"""
+Vectorised carbonate system speciation using Ks from calc_Ks.
+
+Given any two of DIC, ALK, pH and pCO2, calc_carbonate_system returns the
+full speciation of the carbonate, borate, water, sulphate, fluoride,
+phosphate and silicate systems. Where [H+] must be found iteratively
+(ALK with DIC or pCO2) a safeguarded Newton solver is run for a fixed
+maximum number of iterations across all points at once.
+
+All concentrations are in mol/kg-SW, pCO2 is in atm, and pH is on the
+Total scale, consistent with the Ks from calc_Ks. pCO2 is treated as
+equal to fCO2 (i.e. no fugacity correction is applied).
+"""
+import numpy as np
+from .K_functions import calc_Ks, calc_sulphate, calc_fluorine
+
+CARBONATE_KS = ['K0', 'K1', 'K2', 'KW', 'KB', 'KS', 'KF', 'KP1', 'KP2', 'KP3', 'KSi', 'KspC', 'KspA']
+
+def calc_boron(sal):
+    """
+    Calculate total Boron in mol/kg-SW
+
+    From Uppstrom (1974), as in Dickson et al., 2007, Table 2
+    """
+    return 0.0004157 * sal / 35  # mol/kg-SW
+
+def calc_noncarbonate_alkalinity(H, Ks, BT, TP, TSi, ST, FT):
+    """Calculate the non-carbonate components of total alkalinity.
+
+    Parameters
+    ----------
+    H : array-like
+        [H+] on the Total scale.
+    Ks : dict
+        Containing K0, K1, K2, KW, KB, KS, KF, KP1, KP2, KP3 and KSi.
+    BT, TP, TSi, ST, FT : array-like
+        Total boron, phosphate, silicate, sulphate and fluorine in mol/kg-SW.
+
+    Returns
+    -------
+    tuple of array-like
+        Non-carbonate alkalinity and its derivative with respect to H.
+    """
+    KP1, KP2, KP3 = Ks['KP1'], Ks['KP2'], Ks['KP3']
+    free_factor = 1 / (1 + ST / Ks['KS'])
+    H_free = H * free_factor
+
+    alk = BT * Ks['KB'] / (Ks['KB'] + H)
+    dalk = -BT * Ks['KB'] / (Ks['KB'] + H) ** 2
+
+    alk = alk + Ks['KW'] / H
+    dalk = dalk - Ks['KW'] / H ** 2
+
+    P_num = KP1 * KP2 * H + 2 * KP1 * KP2 * KP3 - H ** 3
+    P_den = H ** 3 + KP1 * H ** 2 + KP1 * KP2 * H + KP1 * KP2 * KP3
+    alk = alk + TP * P_num / P_den
+    dalk = dalk + TP * ((KP1 * KP2 - 3 * H ** 2) * P_den - P_num * (3 * H ** 2 + 2 * KP1 * H + KP1 * KP2)) / P_den ** 2
+
+    alk = alk + TSi * Ks['KSi'] / (Ks['KSi'] + H)
+    dalk = dalk - TSi * Ks['KSi'] / (Ks['KSi'] + H) ** 2
+
+    # free H+, HSO4- and HF are subtracted (KS and KF are on the free scale)
+    alk = alk - H_free - ST * H_free / (H_free + Ks['KS']) - FT * H_free / (H_free + Ks['KF'])
+    dalk = dalk - free_factor * (
+        1 + ST * Ks['KS'] / (H_free + Ks['KS']) ** 2 + FT * Ks['KF'] / (H_free + Ks['KF']) ** 2
+    )
+
+    return alk, dalk
+
+def _solve_pH(alkalinity, lo=2.0, hi=14.0, n_iter=50, tol=1e-12):
+    # Safeguarded Newton solver for pH, where alkalinity(H) returns (f, df/dH)
+    # and f increases with pH. Falls back to bisection whenever a Newton
+    # step leaves the current bracket.
+    lo, hi = np.broadcast_arrays(*[np.array(v, dtype=float) for v in (lo, hi)])
+    lo, hi = lo.copy(), hi.copy()
+    pH = np.full(lo.shape, 8.0)
+    for _ in range(n_iter):
+        H = 10 ** -pH
+        f, df_dH = alkalinity(H)
+        df_dpH = -np.log(10) * H * df_dH
+        hi = np.where(f > 0, pH, hi)
+        lo = np.where(f > 0, lo, pH)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new = pH - f / df_dpH
+        bisect = ~np.isfinite(new) | (new < lo) | (new > hi)
+        new = np.where(bisect, 0.5 * (lo + hi), new)
+        converged = np.all(np.abs(new - pH) < tol)
+        pH = new
+        if converged:
+            break
+    return pH
+
+def calc_carbonate_system(DIC=None, ALK=None, pH=None, pCO2=None, temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0528171, calcium=0.0102821, sulphate=None, fluorine=None, boron=None, phosphate=0.0, silicate=0.0, Ks=None, MyAMI_mode='calculate', MyAMI_tolerance=0.001, n_iter=50):
+    """
+    Calculate the full carbonate system speciation from any two of DIC, ALK, pH and pCO2.
+
+    Parameters
+    ----------
+    DIC : array-like
+        Dissolved inorganic carbon in mol/kg-SW.
+    ALK : array-like
+        Total alkalinity in mol/kg-SW.
+    pH : array-like
+        pH on the Total scale.
+    pCO2 : array-like
+        Partial pressure of CO2 in atm, taken as equal to fCO2.
+    temp_c, sal, p_bar, magnesium, calcium, MyAMI_mode, MyAMI_tolerance
+        As in calc_Ks.
+    sulphate, fluorine, boron : array-like
+        Total sulphate, fluorine and boron in mol/kg-SW. Calculated from
+        salinity if not given.
+    phosphate, silicate : array-like
+        Total phosphate and silicate in mol/kg-SW.
+    Ks : dict
+        Precalculated Ks from calc_Ks, containing at least K0, K1, K2,
+        KW, KB, KS, KF, KP1, KP2, KP3 and KSi. If None, these are
+        calculated once with calc_Ks.
+    n_iter : int
+        Maximum number of solver iterations.
+
+    Returns
+    -------
+    dict
+        Containing pH, H, DIC, ALK, pCO2, CO2, HCO3, CO3, BOH3, BOH4,
+        OH, H_free, HSO4, HF, H3PO4, H2PO4, HPO4, PO4, SiOOH3, and
+        omega_calcite and omega_aragonite if KspC and KspA are available.
+    """
+    given = {k for k, v in (('DIC', DIC), ('ALK', ALK), ('pH', pH), ('pCO2', pCO2)) if v is not None}
+    if len(given) != 2:
+        raise ValueError(f'Exactly two of DIC, ALK, pH and pCO2 must be given - got {sorted(given)}')
+
+    if temp_c is None:
+        temp_c = 25.0
+    if sal is None:
+        sal = 35.0
+    if p_bar is None:
+        p_bar = 0.0
+
+    if Ks is None:
+        Ks = calc_Ks(K_list=CARBONATE_KS, temp_c=temp_c, sal=sal, p_bar=p_bar, magnesium=magnesium, calcium=calcium, sulphate=sulphate, fluorine=fluorine, MyAMI_mode=MyAMI_mode, MyAMI_tolerance=MyAMI_tolerance)
+
+    if sulphate is None:
+        sulphate = calc_sulphate(sal=sal)
+    if fluorine is None:
+        fluorine = calc_fluorine(sal=sal)
+    if boron is None:
+        boron = calc_boron(sal=sal)
+
+    K0, K1, K2 = Ks['K0'], Ks['K1'], Ks['K2']
+
+    def noncarbonate(H):
+        return calc_noncarbonate_alkalinity(H, Ks, BT=boron, TP=phosphate, TSi=silicate, ST=sulphate, FT=fluorine)
+
+    if given == {'DIC', 'ALK'}:
+        def alkalinity(H):
+            alk, dalk = noncarbonate(H)
+            D = H ** 2 + K1 * H + K1 * K2
+            N = K1 * H + 2 * K1 * K2
+            return alk + DIC * N / D - ALK, dalk + DIC * (K1 * D - N * (2 * H + K1)) / D ** 2
+        pH = _solve_pH(alkalinity, n_iter=n_iter)
+    elif given == {'pCO2', 'ALK'}:
+        CO2 = K0 * pCO2
+        def alkalinity(H):
+            alk, dalk = noncarbonate(H)
+            return alk + CO2 * (K1 / H + 2 * K1 * K2 / H ** 2) - ALK, dalk - CO2 * (K1 / H ** 2 + 4 * K1 * K2 / H ** 3)
+        pH = _solve_pH(alkalinity, n_iter=n_iter)
+    elif given == {'DIC', 'pCO2'}:
+        CO2 = K0 * pCO2
+        a = DIC - CO2
+        H = (CO2 * K1 + np.sqrt((CO2 * K1) ** 2 + 4 * a * CO2 * K1 * K2)) / (2 * a)
+        pH = -np.log10(H)
+
+    H = 10 ** -np.asarray(pH, dtype=float)
+    D = H ** 2 + K1 * H + K1 * K2
+
+    if DIC is None:
+        if pCO2 is not None:
+            DIC = K0 * pCO2 * D / H ** 2
+        else:
+            alk, _ = noncarbonate(H)
+            DIC = (ALK - alk) * D / (K1 * H + 2 * K1 * K2)
+
+    out = {
+        'pH': -np.log10(H),
+        'H': H,
+        'DIC': DIC,
+        'CO2': DIC * H ** 2 / D,
+        'HCO3': DIC * K1 * H / D,
+        'CO3': DIC * K1 * K2 / D,
+    }
+    out['pCO2'] = out['CO2'] / K0
+    out['ALK'] = noncarbonate(H)[0] + out['HCO3'] + 2 * out['CO3']
+
+    out['BOH4'] = boron * Ks['KB'] / (Ks['KB'] + H)
+    out['BOH3'] = boron - out['BOH4']
+    out['OH'] = Ks['KW'] / H
+    out['H_free'] = H / (1 + sulphate / Ks['KS'])
+    out['HSO4'] = sulphate * out['H_free'] / (out['H_free'] + Ks['KS'])
+    out['HF'] = fluorine * out['H_free'] / (out['H_free'] + Ks['KF'])
+
+    KP1, KP2, KP3 = Ks['KP1'], Ks['KP2'], Ks['KP3']
+    P_den = H ** 3 + KP1 * H ** 2 + KP1 * KP2 * H + KP1 * KP2 * KP3
+    out['H3PO4'] = phosphate * H ** 3 / P_den
+    out['H2PO4'] = phosphate * KP1 * H ** 2 / P_den
+    out['HPO4'] = phosphate * KP1 * KP2 * H / P_den
+    out['PO4'] = phosphate * KP1 * KP2 * KP3 / P_den
+    out['SiOOH3'] = silicate * Ks['KSi'] / (Ks['KSi'] + H)
+
+    if 'KspC' in Ks and 'KspA' in Ks:
+        # calcium is the average seawater concentration, so scale to salinity
+        Ca = (0.0102821 if calcium is None else calcium) * sal / 35
+        out['omega_calcite'] = Ca * out['CO3'] / Ks['KspC']
+        out['omega_aragonite'] = Ca * out['CO3'] / Ks['KspA']
+
+    return out
@@ -1,5 +1,6 @@
 import json
 import os
+import numpy as np
 import pkg_resources as pkgrs
 
 coef_path = pkgrs.resource_filename('kgen', 'coefficients')
@@ -9,3 +10,78 @@ with open(os.path.join(coef_path, 'K_calculation.json'), 'r') as f:
 
 with open(os.path.join(coef_path, 'K_pressure_correction.json'), 'r') as f:
     K_presscorr_coefs = json.load(f)['coefficients']
+
+# Registered coefficient sets, by name. Each contains 'K_calculation' and
+# 'K_pressure_correction' coefficients for every K.
+coefficient_sets = {}
+
+def register_coefficient_set(name, K_calculation=None, K_pressure_correction=None):
+    """Register a set of coefficients, for use with calc_Ks.
+
+    Sets are loaded once, and can then be evaluated side by side by
+    passing their names as coefficient_sets to calc_Ks.
+
+    Parameters
+    ----------
+    name : str
+        Name of the set.
+    K_calculation, K_pressure_correction : str, os.PathLike or dict
+        Path to a .json file in the format of those in the 'coefficients'
+        folder, or a dict of coefficients for each K. Ks that are not
+        given take the default coefficients.
+    """
+    coefficient_set = {}
+    for key, coefs, default in (('K_calculation', K_calculation, K_coefs), ('K_pressure_correction', K_pressure_correction, K_presscorr_coefs)):
+        if isinstance(coefs, (str, os.PathLike)):
+            with open(coefs, 'r') as f:
+                coefs = json.load(f)['coefficients']
+        coefs = {} if coefs is None else coefs
+
+        unknown = set(coefs) - set(default)
+        if unknown:
+            raise ValueError(f'Unknown Ks {sorted(unknown)} in {key} coefficients - must be any of {list(default)}')
+        for k, v in coefs.items():
+            if len(v) != len(default[k]):
+                raise ValueError(f'{key} coefficients for {k} should have length {len(default[k])}, not {len(v)}')
+        coefficient_set[key] = {k: list(coefs.get(k, v)) for k, v in default.items()}
+
+    coefficient_sets[name] = coefficient_set
+
+register_coefficient_set('default')
+
+def stack_coefficient_sets(names, ndim=0):
+    """Combine registered coefficient sets, to evaluate them in one pass.
+
+    Parameters
+    ----------
+    names : list of str
+        Names of registered coefficient sets.
+    ndim : int
+        Number of dimensions of the inputs the coefficients will be used
+        with.
+
+    Returns
+    -------
+    tuple of dict
+        K calculation and pressure correction coefficients for each K.
+        Where all the sets share the same coefficients for a K, these are
+        a list as in K_coefs. Otherwise they are an array of shape
+        (n_coefficients, n_sets) + (1,) * ndim, so that each coefficient
+        broadcasts against the inputs along a new leading axis.
+    """
+    for name in names:
+        if name not in coefficient_sets:
+            raise ValueError(f"Unknown coefficient set '{name}' - must be one of {list(coefficient_sets)}")
+
+    stacked = []
+    for key in ('K_calculation', 'K_pressure_correction'):
+        coefs = {}
+        for k, v in coefficient_sets[names[0]][key].items():
+            values = [coefficient_sets[name][key][k] for name in names]
+            if all(value == v for value in values):
+                coefs[k] = v
+            else:
+                coefs[k] = np.array(values, dtype=float).T.reshape((len(v), len(names)) + (1,) * ndim)
+                coefs[k].setflags(write=False)  # shared between calls, so never updated in place
+        stacked.append(coefs)
+    return tuple(stacked)
@@ -0,0 +1,565 @@
+"""
+Analytic derivatives of the equilibrium constants with respect to temperature, salinity and pressure.
+
+Each function in dK_fns mirrors the corresponding function in K_fns, and
+returns the K together with its derivatives with respect to temp_c and sal.
+calc_Ks_jacobian combines these with the derivatives of the pressure
+correction, the TOT <-> SWS pH scale conversion and the seawater
+correction to give the derivatives of the final Ks returned by calc_Ks.
+The derivatives are calculated with NumPy - for JAX or PyTorch arrays,
+use their automatic differentiation of calc_Ks instead.
+"""
+from itertools import combinations_with_replacement
+import numpy as np
+from pymyami import calculate_seawater_correction
+from .coefs import stack_coefficient_sets
+from .approximation_error import calc_approximation_error
+from .backend import is_numpy
+from .K_functions import K_fns, calc_ionic_strength, calc_sulphate, calc_fluorine, calc_seawater_correction, _calc_Ks_arguments
+
+LN10 = np.log(10)
+
+def calc_dionic_strength(sal):
+    # Derivative of calc_ionic_strength with respect to salinity
+    return 19.924 * 1000 / (1000 - 1.005 * sal) ** 2
+
+def calc_K1K2_derivatives(coefficients, temp_c, sal):
+    """Calculate K1 or K2 and their derivatives from given parameters
+
+    Parameters
+    ----------
+    coefficients : array-like
+        coefficients for K calculation
+    temp_c : array-like
+        Temperature in Celcius
+    sal : array-like
+        Salinity
+
+    Returns
+    -------
+    tuple of array-like
+        K, dK/dtemp_c and dK/dsal.
+    """
+    temp_k = temp_c + 273.15
+    lnK = LN10 * (
+        coefficients[0] +
+        coefficients[1] / temp_k +
+        coefficients[2] * np.log(temp_k) +
+        coefficients[3] * sal +
+        coefficients[4] * sal * sal
+    )
+    dT = LN10 * (-coefficients[1] / temp_k ** 2 + coefficients[2] / temp_k)
+    dS = LN10 * (coefficients[3] + 2 * coefficients[4] * sal)
+    K = np.exp(lnK)
+    return K, K * dT, K * dS
+
+def calc_KW_derivatives(coefficients, temp_c, sal):
+    """Calculate KW and its derivatives from given parameters.
+
+    Parameters and returns as in calc_K1K2_derivatives.
+    """
+    temp_k = temp_c + 273.15
+    ln_temp_k = np.log(temp_k)
+    sqrt_sal = np.sqrt(sal)
+    sal_term = coefficients[3] / temp_k + coefficients[4] + coefficients[5] * ln_temp_k
+    lnK = (
+        coefficients[0] +
+        coefficients[1] / temp_k +
+        coefficients[2] * ln_temp_k +
+        sal_term * sqrt_sal +
+        coefficients[6] * sal
+    )
+    dT = (
+        -coefficients[1] / temp_k ** 2 +
+        coefficients[2] / temp_k +
+        (-coefficients[3] / temp_k ** 2 + coefficients[5] / temp_k) * sqrt_sal
+    )
+    dS = sal_term * 0.5 / sqrt_sal + coefficients[6]
+    K = np.exp(lnK)
+    return K, K * dT, K * dS
+
+def calc_KB_derivatives(coefficients, temp_c, sal):
+    """Calculate KB and its derivatives from given parameters.
+
+    Parameters and returns as in calc_K1K2_derivatives.
+    """
+    temp_k = temp_c + 273.15
+    ln_temp_k = np.log(temp_k)
+    sqrt_sal = np.sqrt(sal)
+    a = coefficients[0] + coefficients[1] * sqrt_sal + coefficients[2] * sal
+    b = (
+        coefficients[3] +
+        coefficients[4] * sqrt_sal +
+        coefficients[5] * sal +
+        coefficients[6] * sal * sqrt_sal +
+        coefficients[7] * sal * sal
+    )
+    c = coefficients[8] + coefficients[9] * sqrt_sal + coefficients[10] * sal
+    lnK = a + b / temp_k + c * ln_temp_k + coefficients[11] * sqrt_sal * temp_k
+
+    dT = -b / temp_k ** 2 + c / temp_k + coefficients[11] * sqrt_sal
+    da = 0.5 * coefficients[1] / sqrt_sal + coefficients[2]
+    db = 0.5 * coefficients[4] / sqrt_sal + coefficients[5] + 1.5 * coefficients[6] * sqrt_sal + 2 * coefficients[7] * sal
+    dc = 0.5 * coefficients[9] / sqrt_sal + coefficients[10]
+    dS = da + db / temp_k + dc * ln_temp_k + 0.5 * coefficients[11] * temp_k / sqrt_sal
+    K = np.exp(lnK)
+    return K, K * dT, K * dS
+
+def calc_K0_derivatives(coefficients, temp_c, sal):
+    """Calculate K0 and its derivatives from given parameters.
+
+    Parameters and returns as in calc_K1K2_derivatives.
+    """
+    temp_k = temp_c + 273.15
+    t100 = temp_k / 100
+    sal_term = coefficients[3] + coefficients[4] * t100 + coefficients[5] * t100 * t100
+    lnK = (
+        coefficients[0] +
+        coefficients[1] / t100 +
+        coefficients[2] * np.log(t100) +
+        sal * sal_term
+    )
+    dT = (
+        -coefficients[1] * 100 / temp_k ** 2 +
+        coefficients[2] / temp_k +
+        sal * (coefficients[4] / 100 + 2 * coefficients[5] * t100 / 100)
+    )
+    dS = sal_term
+    K = np.exp(lnK)
+    return K, K * dT, K * dS
+
+def calc_KS_derivatives(coefficients, temp_c, sal):
+    """Calculate KS and its derivatives from given parameters.
+
+    Parameters and returns as in calc_K1K2_derivatives.
+    """
+    Istr = calc_ionic_strength(sal)
+    dIstr = calc_dionic_strength(sal)
+    sqrt_Istr = np.sqrt(Istr)
+    temp_k = temp_c + 273.15
+    ln_temp_k = np.log(temp_k)
+    a = coefficients[3] / temp_k + coefficients[4] + coefficients[5] * ln_temp_k
+    b = coefficients[6] / temp_k + coefficients[7] + coefficients[8] * ln_temp_k
+    lnK = (
+        coefficients[0]
+        + coefficients[1] / temp_k
+        + coefficients[2] * ln_temp_k
+        + sqrt_Istr * a
+        + Istr * b
+        + coefficients[9] / temp_k * Istr * sqrt_Istr
+        + coefficients[10] / temp_k * Istr ** 2
+        + np.log(1 - 0.001005 * sal)
+    )
+    dT = (
+        -coefficients[1] / temp_k ** 2
+        + coefficients[2] / temp_k
+        + sqrt_Istr * (-coefficients[3] / temp_k ** 2 + coefficients[5] / temp_k)
+        + Istr * (-coefficients[6] / temp_k ** 2 + coefficients[8] / temp_k)
+        - coefficients[9] / temp_k ** 2 * Istr * sqrt_Istr
+        - coefficients[10] / temp_k ** 2 * Istr ** 2
+    )
+    dS = (
+        dIstr * (
+            0.5 * a / sqrt_Istr
+            + b
+            + 1.5 * coefficients[9] / temp_k * sqrt_Istr
+            + 2 * coefficients[10] / temp_k * Istr
+        )
+        - 0.001005 / (1 - 0.001005 * sal)
+    )
+    K = np.exp(lnK)
+    return K, K * dT, K * dS
+
+def calc_Ksp_derivatives(coefficients, temp_c, sal):
+    """Calculate KspA or KspC and their derivatives from given parameters
+
+    Parameters and returns as in calc_K1K2_derivatives.
+    """
+    temp_k = temp_c + 273.15
+    sqrt_sal = np.sqrt(sal)
+    sal_term = coefficients[4] + coefficients[5] * temp_k + coefficients[6] / temp_k
+    lnK = LN10 * (
+        coefficients[0] +
+        coefficients[1] * temp_k +
+        coefficients[2] / temp_k +
+        coefficients[3] * np.log10(temp_k) +
+        sal_term * sqrt_sal +
+        coefficients[7] * sal +
+        coefficients[8] * sal * sqrt_sal
+    )
+    dT = LN10 * (
+        coefficients[1] -
+        coefficients[2] / temp_k ** 2 +
+        coefficients[3] / (temp_k * LN10) +
+        (coefficients[5] - coefficients[6] / temp_k ** 2) * sqrt_sal
+    )
+    dS = LN10 * (0.5 * sal_term / sqrt_sal + coefficients[7] + 1.5 * coefficients[8] * sqrt_sal)
+    K = np.exp(lnK)
+    return K, K * dT, K * dS
+
+def calc_KP_derivatives(coefficients, temp_c, sal):
+    """Calculate KP1 or KP2 and their derivatives from given parameters
+
+    Parameters and returns as in calc_K1K2_derivatives.
+    """
+    temp_k = temp_c + 273.15
+    sqrt_sal = np.sqrt(sal)
+    lnK = (
+        coefficients[0] / temp_k
+        + coefficients[1]
+        + coefficients[2] * np.log(temp_k)
+        + (coefficients[3] / temp_k + coefficients[4]) * sqrt_sal
+        + (coefficients[5] / temp_k + coefficients[6]) * sal
+    )
+    dT = (
+        -coefficients[0] / temp_k ** 2
+        + coefficients[2] / temp_k
+        - coefficients[3] * sqrt_sal / temp_k ** 2
+        - coefficients[5] * sal / temp_k ** 2
+    )
+    dS = 0.5 * (coefficients[3] / temp_k + coefficients[4]) / sqrt_sal + coefficients[5] / temp_k + coefficients[6]
+    K = np.exp(lnK)
+    return K, K * dT, K * dS
+
+def calc_KP3_derivatives(coefficients, temp_c, sal):
+    """Calculate KP3 and its derivatives from given parameters
+
+    Parameters and returns as in calc_K1K2_derivatives.
+    """
+    temp_k = temp_c + 273.15
+    sqrt_sal = np.sqrt(sal)
+    lnK = (
+        coefficients[0] / temp_k
+        + coefficients[1]
+        + (coefficients[2] / temp_k + coefficients[3]) * sqrt_sal
+        + (coefficients[4] / temp_k + coefficients[5]) * sal
+    )
+    dT = (
+        -coefficients[0] / temp_k ** 2
+        - coefficients[2] * sqrt_sal / temp_k ** 2
+        - coefficients[4] * sal / temp_k ** 2
+    )
+    dS = 0.5 * (coefficients[2] / temp_k + coefficients[3]) / sqrt_sal + coefficients[4] / temp_k + coefficients[5]
+    K = np.exp(lnK)
+    return K, K * dT, K * dS
+
+def calc_KSi_derivatives(coefficients, temp_c, sal):
+    """Calculate KSi and its derivatives from given parameters
+
+    Parameters and returns as in calc_K1K2_derivatives.
+    """
+    Istr = calc_ionic_strength(sal)
+    dIstr = calc_dionic_strength(sal)
+    sqrt_Istr = np.sqrt(Istr)
+    temp_k = temp_c + 273.15
+    lnK = (
+        coefficients[0] / temp_k +
+        coefficients[1] +
+        coefficients[2] * np.log(temp_k) +
+        (coefficients[3] / temp_k + coefficients[4]) * sqrt_Istr +
+        (coefficients[5] / temp_k + coefficients[6]) * Istr +
+        (coefficients[7] / temp_k + coefficients[8]) * Istr ** 2 +
+        np.log(1 - 0.001005 * sal)
+    )
+    dT = (
+        -coefficients[0] / temp_k ** 2 +
+        coefficients[2] / temp_k -
+        coefficients[3] * sqrt_Istr / temp_k ** 2 -
+        coefficients[5] * Istr / temp_k ** 2 -
+        coefficients[7] * Istr ** 2 / temp_k ** 2
+    )
+    dS = (
+        dIstr * (
+            0.5 * (coefficients[3] / temp_k + coefficients[4]) / sqrt_Istr +
+            (coefficients[5] / temp_k + coefficients[6]) +
+            2 * (coefficients[7] / temp_k + coefficients[8]) * Istr
+        )
+        - 0.001005 / (1 - 0.001005 * sal)
+    )
+    K = np.exp(lnK)
+    return K, K * dT, K * dS
+
+def calc_KF_derivatives(coefficients, temp_c, sal):
+    """Calculate KF and its derivatives from given parameters
+
+    Parameters and returns as in calc_K1K2_derivatives.
+    """
+    temp_k = temp_c + 273.15
+    sqrt_sal = np.sqrt(sal)
+    lnK = coefficients[0] / temp_k + coefficients[1] + coefficients[2] * sqrt_sal
+    dT = -coefficients[0] / temp_k ** 2
+    dS = 0.5 * coefficients[2] / sqrt_sal
+    K = np.exp(lnK)
+    return K, K * dT, K * dS
+
+dK_fns = {
+    "K0": calc_K0_derivatives,
+    "K1": calc_K1K2_derivatives,
+    "K2": calc_K1K2_derivatives,
+    "KW": calc_KW_derivatives,
+    "KB": calc_KB_derivatives,
+    "KS": calc_KS_derivatives,
+    "KspA": calc_Ksp_derivatives,
+    "KspC": calc_Ksp_derivatives,
+    "KP1": calc_KP_derivatives,
+    "KP2": calc_KP_derivatives,
+    "KP3": calc_KP3_derivatives,
+    "KSi": calc_KSi_derivatives,
+    "KF": calc_KF_derivatives
+}
+
+def calc_pressure_correction_derivatives(coefficients, p_bar, temp_c):
+    """Calculate pressure correction factor and its derivatives.
+
+    See calc_pressure_correction.
+
+    Parameters
+    ----------
+    coefficients : array-like
+        parameters to calculate pressure correction factors (Kcorr).
+    p_bar : array-like
+        Pressure in bar
+    temp_c : array-like
+        Temperature in Celcius
+
+    Returns
+    -------
+    tuple of array-like
+        Pressure correction factor, and its derivatives with respect to
+        temp_c and p_bar.
+    """
+    a0, a1, a2, b0, b1 = coefficients
+    dV = a0 + a1 * temp_c + a2 * temp_c ** 2
+    dk = (b0 + b1 * temp_c)
+    RT = 83.1451 * (temp_c + 273.15)
+    ln_pc = (-dV + 0.5 * dk * p_bar) * p_bar / RT
+    dT = (-(a1 + 2 * a2 * temp_c) + 0.5 * b1 * p_bar) * p_bar / RT - ln_pc / (temp_c + 273.15)
+    dP = (-dV + dk * p_bar) / RT
+    pc = np.exp(ln_pc)
+    return pc, pc * dT, pc * dP
+
+def approximate_seawater_correction_derivatives(ks, temp_c, sal, magnesium, calcium):
+    """Derivatives of the polynomial MyAMI approximation.
+
+    Parameters
+    ----------
+    ks : array-like
+        list of strings for names of K's
+    temp_c, sal, magnesium, calcium : array-like
+        As in calc_seawater_correction.
+
+    Returns
+    -------
+    dict
+        Containing the derivatives of the seawater correction factors with
+        respect to temp_c and sal, as {K: (d/dtemp_c, d/dsal)}.
+    """
+    # coefficients of the polynomial fitted in pymyami 2.1.0, imported here as they are not part of its public API
+    from pymyami.approximate import SEAWATER_CORRECTION_COEFS
+
+    temp_c, sal, magnesium, calcium = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (temp_c, sal, magnesium, calcium)])
+    temp_k = temp_c.ravel() + 273.15
+    X = np.vstack([temp_k, np.log(temp_k), sal.ravel(), magnesium.ravel(), calcium.ravel()]).T
+    # powers of each feature in every term, in the order of sklearn's PolynomialFeatures(degree=3)
+    n_features = X.shape[1]
+    powers = np.array([np.bincount(c, minlength=n_features) for degree in range(4) for c in combinations_with_replacement(range(n_features), degree)])
+
+    def dfeatures(j):
+        # derivative of each polynomial feature with respect to X[:, j]
+        p = powers.copy()
+        scale = p[:, j].astype(float)
+        p[:, j] = np.maximum(p[:, j] - 1, 0)
+        return scale * np.prod(X[:, None, :] ** p[None, :, :], axis=2)
+
+    dX_dT = dfeatures(0) + dfeatures(1) / temp_k[:, None]
+    dX_dS = dfeatures(2)
+
+    return {k: (dX_dT.dot(c).reshape(temp_c.shape), dX_dS.dot(c).reshape(temp_c.shape)) for k, c in SEAWATER_CORRECTION_COEFS.items() if k in ks}
+
+def calc_seawater_correction_derivatives(ks, temp_c, sal, magnesium, calcium, MyAMI_mode='calculate', MyAMI_tolerance=0.001, dtemp_c=1e-3, dsal=1e-3):
+    """Calculate derivatives of the seawater correction factors.
+
+    The polynomial used in 'approximate' mode is differentiated
+    analytically. The full MyAMI model has no analytic derivative, so
+    in 'calculate' mode the derivatives are calculated by central
+    differences, with all the perturbed points in a single MyAMI call.
+    In 'auto' mode, whether each point is approximated is decided once
+    at the given conditions, as in calc_seawater_correction, so both
+    sides of a difference always use the same method.
+
+    Parameters
+    ----------
+    ks : array-like
+        list of strings for names of K's
+    temp_c, sal, magnesium, calcium, MyAMI_mode, MyAMI_tolerance
+        As in calc_seawater_correction.
+    dtemp_c, dsal : float
+        Step sizes for central differences.
+
+    Returns
+    -------
+    dict
+        Containing the derivatives of the seawater correction factors with
+        respect to temp_c and sal, as {K: (d/dtemp_c, d/dsal)}.
+    """
+    if MyAMI_mode == 'approximate':
+        return approximate_seawater_correction_derivatives(ks, temp_c=temp_c, sal=sal, magnesium=magnesium, calcium=calcium)
+
+    if isinstance(ks, str):
+        ks = [ks]
+    if magnesium is None:
+        magnesium = 0.0528171
+    if calcium is None:
+        calcium = 0.0102821
+    temp_c, sal, magnesium, calcium = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (temp_c, sal, magnesium, calcium)])
+
+    if MyAMI_mode == 'auto':
+        approximate = calc_approximation_error(ks, temp_c=temp_c, sal=sal, magnesium=magnesium, calcium=calcium) <= MyAMI_tolerance
+    elif MyAMI_mode == 'calculate':
+        approximate = np.zeros(temp_c.shape, dtype=bool)
+    else:
+        raise ValueError("Unknown MyAMI_mode - must be 'calculate', 'approximate' or 'auto'")
+    calculate = ~approximate
+
+    derivatives = {}
+    def insert(k, mask, dT, dS):
+        if k not in derivatives:
+            derivatives[k] = (np.zeros(temp_c.shape), np.zeros(temp_c.shape))
+        derivatives[k][0][mask] = dT
+        derivatives[k][1][mask] = dS
+
+    if np.any(approximate):
+        approximated = approximate_seawater_correction_derivatives(ks, temp_c=temp_c[approximate], sal=sal[approximate], magnesium=magnesium[approximate], calcium=calcium[approximate])
+        for k, (dT, dS) in approximated.items():
+            insert(k, approximate, dT, dS)
+
+    if np.any(calculate):
+        # (T + dT, T - dT, S + dS, S - dS) stacked along a leading axis
+        t, s, mg, ca = temp_c[calculate], sal[calculate], magnesium[calculate], calcium[calculate]
+        steps = np.array([dtemp_c, -dtemp_c, 0., 0.])[:, None]
+        sal_steps = np.array([0., 0., dsal, -dsal])[:, None]
+        calculated = calculate_seawater_correction(Sal=s + sal_steps, TempC=t + steps, Mg=np.broadcast_to(mg, (4, t.size)), Ca=np.broadcast_to(ca, (4, t.size)))
+        for k in ks:
+            if k in calculated:
+                T_hi, T_lo, S_hi, S_lo = np.asarray(calculated[k]).reshape(4, t.size)
+                insert(k, calculate, (T_hi - T_lo) / (2 * dtemp_c), (S_hi - S_lo) / (2 * dsal))
+
+    return derivatives
+
+def _dln_tot_to_sws(a, b, dln_a, dln_b):
+    # derivative of ln((1 + a + b) / (1 + a)), given the log-derivatives of a and b
+    return (a * dln_a + b * dln_b) / (1 + a + b) - a * dln_a / (1 + a)
+
+def calc_Ks_jacobian(K_list=None, temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0528171, calcium=0.0102821, sulphate=None, fluorine=None, MyAMI_mode='calculate', MyAMI_tolerance=0.001, coefficient_sets=None):
+    """
+    Calculate specified Ks and their derivatives with respect to temperature, salinity and pressure.
+
+    The Ks are calculated as in calc_Ks, and the derivatives are
+    calculated analytically, including the pressure correction, the
+    TOT <-> SWS conversion around the pressure correction and the
+    seawater correction (see calc_seawater_correction_derivatives).
+    Where sulphate and fluorine are calculated from salinity, their
+    dependence on salinity is included.
+
+    Parameters
+    ----------
+    K_list, temp_c, sal, p_bar, magnesium, calcium, sulphate, fluorine, MyAMI_mode, MyAMI_tolerance, coefficient_sets
+        As in calc_Ks. Only NumPy inputs are supported.
+
+    Returns
+    -------
+    Ks : dict
+        Containing calculated Ks.
+    jacobian : dict
+        Containing the derivatives of each K, as
+        {K: {'temp_c': dK/dtemp_c, 'sal': dK/dsal, 'p_bar': dK/dp_bar}}.
+    """
+    if K_list is None:
+        K_list = K_fns.keys()
+
+    inputs, options = _calc_Ks_arguments(temp_c=temp_c, sal=sal, p_bar=p_bar, magnesium=magnesium, calcium=calcium, sulphate=sulphate, fluorine=fluorine, MyAMI_mode=MyAMI_mode, MyAMI_tolerance=MyAMI_tolerance, pH_scale='total', coefficient_sets=coefficient_sets)
+    if not is_numpy(options['xp']):
+        raise ValueError('calc_Ks_jacobian is only available for NumPy inputs - differentiate calc_Ks with JAX or PyTorch instead')
+    temp_c, sal, p_bar = inputs['temp_c'], inputs['sal'], inputs['p_bar']
+
+    # as in _calc_Ks, coefficients that differ between sets broadcast along a leading axis
+    shape = np.broadcast_shapes(*[np.shape(v) for v in inputs.values() if v is not None])
+    K_coefs, K_presscorr_coefs = stack_coefficient_sets(options['coefficient_sets'], ndim=len(shape))
+
+    # log-derivatives of total fluorine and sulphate with respect to salinity
+    if fluorine is None:
+        fluorine = calc_fluorine(sal=sal)
+        dln_fluorine = 1 / sal
+    else:
+        dln_fluorine = 0.0
+    if sulphate is None:
+        sulphate = calc_sulphate(sal=sal)
+        dln_sulphate = 1 / sal
+    else:
+        dln_sulphate = 0.0
+
+    if options['seawater']:
+        seawater_corrections = calc_seawater_correction(K_list, temp_c=temp_c, sal=sal, magnesium=magnesium, calcium=calcium, MyAMI_mode=MyAMI_mode, MyAMI_tolerance=MyAMI_tolerance)
+        dseawater_corrections = calc_seawater_correction_derivatives(K_list, temp_c=temp_c, sal=sal, magnesium=magnesium, calcium=calcium, MyAMI_mode=MyAMI_mode, MyAMI_tolerance=MyAMI_tolerance)
+    else:
+        seawater_corrections = {}
+        dseawater_corrections = {}
+
+    pressure = options['pressure']
+
+    # TOT <-> SWS conversion factors and their log-derivatives, shared by all Ks
+    KS_surf, dKS_dT, dKS_dS = dK_fns['KS'](coefficients=K_coefs['KS'], temp_c=temp_c, sal=sal)
+    KF_surf, dKF_dT, dKF_dS = dK_fns['KF'](coefficients=K_coefs['KF'], temp_c=temp_c, sal=sal)
+    pc_KS, dpc_KS_dT, dpc_KS_dP = calc_pressure_correction_derivatives(coefficients=K_presscorr_coefs['KS'], p_bar=p_bar, temp_c=temp_c)
+    pc_KF, dpc_KF_dT, dpc_KF_dP = calc_pressure_correction_derivatives(coefficients=K_presscorr_coefs['KF'], p_bar=p_bar, temp_c=temp_c)
+    KS_deep = KS_surf * pc_KS
+    KF_deep = KF_surf * pc_KF
+
+    tot_to_sws_surface = (1 + sulphate / KS_surf + fluorine / KF_surf) / (1 + sulphate / KS_surf)
+    sws_to_tot_deep = (1 + sulphate / KS_deep) / (1 + sulphate / KS_deep + fluorine / KF_deep)
+
+    a, b = sulphate / KS_surf, fluorine / KF_surf
+    a_deep, b_deep = sulphate / KS_deep, fluorine / KF_deep
+    dln_KS = {'temp_c': dKS_dT / KS_surf, 'sal': dKS_dS / KS_surf, 'p_bar': 0.0}
+    dln_KF = {'temp_c': dKF_dT / KF_surf, 'sal': dKF_dS / KF_surf, 'p_bar': 0.0}
+    dln_pc_KS = {'temp_c': dpc_KS_dT / pc_KS, 'sal': 0.0, 'p_bar': dpc_KS_dP / pc_KS}
+    dln_pc_KF = {'temp_c': dpc_KF_dT / pc_KF, 'sal': 0.0, 'p_bar': dpc_KF_dP / pc_KF}
+    dln_ST = {'temp_c': 0.0, 'sal': dln_sulphate, 'p_bar': 0.0}
+    dln_FT = {'temp_c': 0.0, 'sal': dln_fluorine, 'p_bar': 0.0}
+
+    dln_conversion = {}
+    for x in ('temp_c', 'sal', 'p_bar'):
+        dln_conversion[x] = (
+            _dln_tot_to_sws(a, b, dln_ST[x] - dln_KS[x], dln_FT[x] - dln_KF[x])
+            - _dln_tot_to_sws(a_deep, b_deep, dln_ST[x] - dln_KS[x] - dln_pc_KS[x], dln_FT[x] - dln_KF[x] - dln_pc_KF[x])
+        )
+
+    Ks = {}
+    jacobian = {}
+    for k in K_list:
+        K, dK_dT, dK_dS = dK_fns[k](coefficients=K_coefs[k], temp_c=temp_c, sal=sal)
+        dln_K = {'temp_c': dK_dT / K, 'sal': dK_dS / K, 'p_bar': 0.0 * K}
+
+        if k in K_presscorr_coefs:
+            pc, dpc_dT, dpc_dP = calc_pressure_correction_derivatives(coefficients=K_presscorr_coefs[k], p_bar=p_bar, temp_c=temp_c)
+            if pressure:
+                K = K * (tot_to_sws_surface * pc * sws_to_tot_deep)
+            dln_K['temp_c'] = dln_K['temp_c'] + dln_conversion['temp_c'] + dpc_dT / pc
+            dln_K['sal'] = dln_K['sal'] + dln_conversion['sal']
+            dln_K['p_bar'] = dln_K['p_bar'] + dln_conversion['p_bar'] + dpc_dP / pc
+
+        if k in seawater_corrections:
+            dswc_dT, dswc_dS = dseawater_corrections[k]
+            dln_K['temp_c'] = dln_K['temp_c'] + dswc_dT / seawater_corrections[k]
+            dln_K['sal'] = dln_K['sal'] + dswc_dS / seawater_corrections[k]
+            K = K * seawater_corrections[k]
+
+        Ks[k] = K
+        jacobian[k] = {x: K * v for x, v in dln_K.items()}
+
+    if options['ensemble']:
+        ensemble_shape = (len(options['coefficient_sets']),) + shape
+        Ks = {k: np.array(np.broadcast_to(v, ensemble_shape)) for k, v in Ks.items()}
+        jacobian = {k: {x: np.array(np.broadcast_to(v, ensemble_shape)) for x, v in d.items()} for k, d in jacobian.items()}
+
+    return Ks, jacobian
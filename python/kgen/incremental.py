@@ -0,0 +1,149 @@
+"""
+Incremental recalculation of Ks for fields that change little between calls.
+
+IncrementalKs keeps the calc_Ks output for each named field, along with a
+hash of each block of its inputs. On the next call for the same field only
+the blocks whose inputs have changed are recalculated (including the MyAMI
+seawater correction) and patched into the cached result. Whether the
+pressure and seawater corrections are needed is decided for the whole
+field, so results are the same as calling calc_Ks on it.
+"""
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from .K_functions import K_fns, _calc_Ks, _calc_Ks_arguments, _needs_seawater_correction, _needs_pressure_correction, calc_sulphate, calc_fluorine
+
+INPUT_NAMES = ('temp_c', 'sal', 'p_bar', 'magnesium', 'calcium', 'sulphate', 'fluorine')
+
+class _Field:
+    def __init__(self, key, shape, digests, Ks):
+        self.key = key
+        self.shape = shape
+        self.digests = digests
+        self.Ks = Ks
+
+    @property
+    def nbytes(self):
+        return sum(v.nbytes for v in self.Ks.values()) + len(self.digests) * 16
+
+class IncrementalKs:
+    """Cache of calc_Ks results that recalculates only changed blocks.
+
+    Parameters
+    ----------
+    block_size : int
+        Number of points per block. Inputs are compared block-by-block
+        using a hash, and a whole block is recalculated if any of its
+        inputs change.
+    max_memory : int
+        Maximum number of bytes used by cached fields. When exceeded,
+        the least recently used fields are evicted. A field that is
+        larger than max_memory on its own is calculated but not cached.
+    """
+
+    def __init__(self, block_size=4096, max_memory=2**30):
+        self.block_size = block_size
+        self.max_memory = max_memory
+        self._fields = OrderedDict()
+        self.last_recomputed = 0
+
+    @property
+    def nbytes(self):
+        """int : Number of bytes currently used by cached fields."""
+        return sum(f.nbytes for f in self._fields.values())
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def forget(self, name):
+        """Remove a named field from the cache."""
+        self._fields.pop(name, None)
+
+    def clear(self):
+        """Remove all fields from the cache."""
+        self._fields.clear()
+
+    def _block_digests(self, inputs, n):
+        digests = []
+        for start in range(0, n, self.block_size):
+            h = hashlib.blake2b(digest_size=16)
+            for v in inputs:
+                h.update(v[start:start + self.block_size].tobytes())
+            digests.append(h.digest())
+        return digests
+
+    def calc_Ks(self, name, K_list=None, temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0528171, calcium=0.0102821, sulphate=None, fluorine=None, MyAMI_mode='calculate', MyAMI_tolerance=0.001, pH_scale='total'):
+        """
+        Calculate Ks for a named field, recalculating only changed blocks.
+
+        Parameters
+        ----------
+        name : hashable
+            Name of the field. Results for the previous call with the
+            same name, K_list, MyAMI_mode, MyAMI_tolerance, pH_scale and
+            input shape are reused.
+        K_list, temp_c, sal, p_bar, magnesium, calcium, sulphate, fluorine, MyAMI_mode, MyAMI_tolerance, pH_scale
+            As in calc_Ks.
+
+        Returns
+        -------
+        dict
+            Containing calculated Ks, with the broadcast shape of the inputs.
+        """
+        if K_list is None:
+            K_list = K_fns.keys()
+        if temp_c is None:
+            temp_c = 25.0
+        if sal is None:
+            sal = 35.0
+        if p_bar is None:
+            p_bar = 0.0
+        if magnesium is None:
+            magnesium = 0.0528171
+        if calcium is None:
+            calcium = 0.0102821
+        if sulphate is None:
+            sulphate = calc_sulphate(sal=np.asarray(sal, dtype=float))
+        if fluorine is None:
+            fluorine = calc_fluorine(sal=np.asarray(sal, dtype=float))
+
+        arrays = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (temp_c, sal, p_bar, magnesium, calcium, sulphate, fluorine)])
+        shape = arrays[0].shape
+        n = arrays[0].size
+        inputs = [np.ascontiguousarray(v).reshape(-1) for v in arrays]
+
+        # blocks are corrected as the whole field is, and a change in either correction recalculates every block
+        seawater = _needs_seawater_correction(inputs[3], inputs[4])
+        pressure = _needs_pressure_correction(inputs[2])
+        key = (tuple(K_list), MyAMI_mode, MyAMI_tolerance, pH_scale, seawater, pressure)
+
+        def calculate(values):
+            chunk_inputs, options = _calc_Ks_arguments(**dict(zip(INPUT_NAMES, values)), MyAMI_mode=MyAMI_mode, MyAMI_tolerance=MyAMI_tolerance, pH_scale=pH_scale, coefficient_sets=None, seawater=seawater, pressure=pressure)
+            return _calc_Ks(K_list, **chunk_inputs, **options)
+
+        digests = self._block_digests(inputs, n)
+
+        field = self._fields.get(name)
+        if field is not None and field.key == key and field.shape == shape:
+            changed = [i for i, (new, old) in enumerate(zip(digests, field.digests)) if new != old]
+            if changed:
+                index = np.concatenate([np.arange(i * self.block_size, min((i + 1) * self.block_size, n)) for i in changed])
+                Ks = calculate([v[index] for v in inputs])
+                for k, v in Ks.items():
+                    field.Ks[k][index] = v
+                field.digests = digests
+            self.last_recomputed = sum(min(self.block_size, n - i * self.block_size) for i in changed)
+            self._fields.move_to_end(name)
+        else:
+            Ks = calculate(inputs)
+            field = _Field(key, shape, digests, {k: np.array(np.broadcast_to(v, (n,)), dtype=float) for k, v in Ks.items()})
+            self.last_recomputed = n
+            self._fields[name] = field
+            self._fields.move_to_end(name)
+
+        out = {k: v.reshape(shape).copy() for k, v in field.Ks.items()}
+
+        while self._fields and self.nbytes > self.max_memory:
+            self._fields.popitem(last=False)
+
+        return out
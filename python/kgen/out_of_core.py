@@ -0,0 +1,182 @@
+"""
+Functions for calculating Ks for datasets that are larger than memory.
+
+Inputs are read from .npy files (or np.memmap arrays) and each K is
+written to its own memory-mapped .npy file, working through the data
+in chunks aligned with the pages of the output files, so that only one
+chunk is ever held in memory.
+"""
+import os
+import mmap
+import numpy as np
+from .K_functions import K_fns, _calc_Ks, _calc_Ks_arguments, _needs_seawater_correction, _needs_pressure_correction
+
+DEFAULT_CHUNK_SIZE = 2**20  # elements per chunk (8 MiB per float64 array)
+
+# Values of inputs that are not given, as in calc_Ks
+DEFAULTS = {'temp_c': 25.0, 'sal': 35.0, 'p_bar': 0.0, 'magnesium': 0.0528171, 'calcium': 0.0102821, 'sulphate': None, 'fluorine': None}
+
+def open_input(x):
+    """Open an input for out-of-core calculation without loading it.
+
+    Parameters
+    ----------
+    x : str, os.PathLike, np.memmap, array-like or scalar
+        Paths are opened as read-only memory-mapped .npy files. Anything
+        else is passed through np.asanyarray, so that memmaps are kept as
+        memmaps.
+
+    Returns
+    -------
+    np.ndarray or np.memmap
+    """
+    if isinstance(x, (str, os.PathLike)):
+        return np.load(x, mmap_mode='r')
+    return np.asanyarray(x)
+
+def page_aligned_chunk_size(chunk_size, itemsize):
+    """Round chunk_size down to a whole number of memory pages.
+
+    Parameters
+    ----------
+    chunk_size : int
+        Requested number of elements per chunk.
+    itemsize : int
+        Size of a single element in bytes.
+
+    Returns
+    -------
+    int
+        Number of elements per chunk, a multiple of the number of elements
+        in one memory page (and at least one page).
+    """
+    page_elements = max(1, mmap.PAGESIZE // itemsize)
+    return max(page_elements, (chunk_size // page_elements) * page_elements)
+
+def page_aligned_chunks(n, chunk_size, itemsize, offset=0):
+    """Split n elements into chunks whose boundaries fall on memory pages.
+
+    Parameters
+    ----------
+    n : int
+        Number of elements.
+    chunk_size : int
+        Requested number of elements per chunk, rounded down as in
+        page_aligned_chunk_size.
+    itemsize : int
+        Size of a single element in bytes.
+    offset : int
+        Position in bytes of the first element in its file (e.g. after a
+        .npy header). The first chunk is shortened so that the following
+        chunks start on page boundaries.
+
+    Yields
+    ------
+    tuple of int
+        Start and stop of each chunk.
+    """
+    step = page_aligned_chunk_size(chunk_size, itemsize)
+    start = 0
+    if mmap.PAGESIZE % itemsize == 0 and offset % itemsize == 0:
+        start = min(n, -(offset // itemsize) % (mmap.PAGESIZE // itemsize))
+        if start > 0:
+            yield 0, start
+    for start in range(start, n, step):
+        yield start, min(start + step, n)
+
+def calc_Ks_memmap(out_dir, K_list=None, temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0528171, calcium=0.0102821, sulphate=None, fluorine=None, MyAMI_mode='calculate', MyAMI_tolerance=0.001, pH_scale='total', chunk_size=DEFAULT_CHUNK_SIZE, dtype=np.float64):
+    """
+    Calculate specified stoichiometric equilibrium constants out-of-core.
+
+    Each input may be a path to a .npy file, an np.memmap (e.g. of a
+    raw binary file), an array or a scalar. All array inputs must be
+    C-contiguous and share the same shape; scalars are applied to every
+    point. Each requested K is written to '{out_dir}/{K}.npy'.
+
+    Data are processed sequentially in chunks of `chunk_size` elements
+    (rounded down to a whole number of memory pages, and aligned with the
+    pages of the output files). Whether the pressure and seawater
+    corrections are needed is decided once for the whole dataset, so
+    results are the same as calling calc_Ks on it in memory, to within
+    floating point rounding.
+
+    Parameters
+    ----------
+    out_dir : str or os.PathLike
+        Directory to write output files to. Created if it does not exist.
+    K_list : array-like
+        List of Ks to calculate. All Ks are calculated if None.
+    temp_c, sal, p_bar, magnesium, calcium, sulphate, fluorine : str, np.memmap, array-like or scalar
+        As in calc_Ks.
+    MyAMI_mode, MyAMI_tolerance, pH_scale : str, float, str
+        As in calc_Ks.
+    chunk_size : int
+        Approximate number of elements to process at once.
+    dtype : numpy dtype
+        Data type of the output files.
+
+    Returns
+    -------
+    dict
+        Containing a read-write np.memmap for each calculated K.
+    """
+    if K_list is None:
+        K_list = K_fns.keys()
+
+    inputs = {
+        'temp_c': temp_c,
+        'sal': sal,
+        'p_bar': p_bar,
+        'magnesium': magnesium,
+        'calcium': calcium,
+        'sulphate': sulphate,
+        'fluorine': fluorine,
+    }
+    inputs = {k: open_input(v) for k, v in inputs.items() if v is not None}
+
+    shapes = {v.shape for v in inputs.values() if v.ndim > 0}
+    if len(shapes) > 1:
+        raise ValueError(f'All array inputs must have the same shape - got {shapes}')
+    shape = shapes.pop() if shapes else ()
+
+    for k, v in inputs.items():
+        if v.ndim > 0 and not v.flags.c_contiguous:
+            raise ValueError(f'{k} must be C-contiguous for out-of-core calculation.')
+
+    flat = {k: v.reshape(-1) if v.ndim > 0 else v[()] for k, v in inputs.items()}
+    n = int(np.prod(shape))
+
+    os.makedirs(out_dir, exist_ok=True)
+    Ks = {
+        k: np.lib.format.open_memmap(os.path.join(out_dir, f'{k}.npy'), mode='w+', dtype=dtype, shape=shape)
+        for k in K_list
+    }
+    flat_Ks = {k: v.reshape(-1) for k, v in Ks.items()}
+
+    def read(start, stop, names=DEFAULTS):
+        chunk = {k: DEFAULTS[k] for k in names}
+        chunk.update({k: np.array(v[start:stop]) if np.ndim(v) > 0 else v for k, v in flat.items() if k in names})
+        return chunk
+
+    offset = next(iter(Ks.values())).offset if Ks else 0
+    itemsize = np.dtype(dtype).itemsize
+
+    # decide whether the corrections are needed for the whole dataset, as calc_Ks would
+    seawater = pressure = False
+    for start, stop in page_aligned_chunks(n, chunk_size, itemsize, offset):
+        chunk = read(start, stop, ('p_bar', 'magnesium', 'calcium'))
+        seawater = seawater or _needs_seawater_correction(chunk['magnesium'], chunk['calcium'])
+        pressure = pressure or _needs_pressure_correction(chunk['p_bar'])
+        if seawater and pressure:
+            break
+
+    for start, stop in page_aligned_chunks(n, chunk_size, itemsize, offset):
+        chunk_inputs, options = _calc_Ks_arguments(**read(start, stop), MyAMI_mode=MyAMI_mode, MyAMI_tolerance=MyAMI_tolerance, pH_scale=pH_scale, coefficient_sets=None, seawater=seawater, pressure=pressure)
+        chunk_Ks = _calc_Ks(K_list, **chunk_inputs, **options)
+        for k, v in chunk_Ks.items():
+            flat_Ks[k][start:stop] = v
+
+    for v in Ks.values():
+        v.flush()
+
+    return Ks
@@ -0,0 +1,114 @@
+"""
+Functions for converting pH and equilibrium constants between pH scales.
+
+Conversion factors are calculated from KS and KF (on the free scale) and
+total sulphate and fluorine, so that Ks already calculated by calc_Ks can
+be reused without a second evaluation. All factors are expressed relative
+to the Total scale, on which calc_Ks calculates Ks:
+
+    [H+]_scale = [H+]_Total * factor
+    K_scale = K_Total * factor (for Ks in SCALE_DEPENDENT_KS)
+    pH_scale = pH_Total - log10(factor)
+
+Scales are 'total', 'free', 'seawater' and 'NBS'.
+"""
+from .backend import get_namespace
+
+PH_SCALES = ('total', 'free', 'seawater', 'NBS')
+
+# Ks that are defined with a single [H+] term, and so depend on pH scale.
+# K0, KspA and KspC do not involve H+, and KS and KF define the free scale.
+SCALE_DEPENDENT_KS = ('K1', 'K2', 'KW', 'KB', 'KP1', 'KP2', 'KP3', 'KSi')
+
+def calc_fH(temp_c, sal):
+    """
+    Calculate the activity coefficient of H+ for conversion to the NBS scale.
+
+    From Takahashi et al. (1982), as used in CO2SYS.
+    """
+    temp_k = temp_c + 273.15
+    return 1.2948 - 0.002036 * temp_k + (0.0004607 - 0.000001475 * temp_k) * sal ** 2
+
+def calc_pH_scale_factors(KS, KF, sulphate, fluorine, temp_c=None, sal=None):
+    """Calculate conversion factors from the Total scale to all pH scales.
+
+    Parameters
+    ----------
+    KS, KF : array-like
+        Dissociation constants of HSO4- and HF on the free scale.
+    sulphate, fluorine : array-like
+        Total sulphate and fluorine in mol/kgsw.
+    temp_c, sal : array-like
+        Temperature in Celcius and salinity. Only needed for the NBS scale,
+        which is omitted if they are not given.
+
+    Returns
+    -------
+    dict
+        Containing the factor from the Total scale to each pH scale.
+    """
+    free = 1 / (1 + sulphate / KS)
+    factors = {
+        'total': 1.0,
+        'free': free,
+        'seawater': 1 + free * fluorine / KF,
+    }
+    if temp_c is not None and sal is not None:
+        factors['NBS'] = factors['seawater'] * calc_fH(temp_c=temp_c, sal=sal)
+    return factors
+
+def _check_scale(scale, factors):
+    if scale not in PH_SCALES:
+        raise ValueError(f"Unknown pH scale '{scale}' - must be one of {PH_SCALES}")
+    if scale not in factors:
+        raise ValueError(f"Conversion factors for the '{scale}' scale are not available - temp_c and sal are needed for the NBS scale")
+
+def convert_pH_scale(pH, factors, from_scale='total', to_scale='free'):
+    """Convert pH between scales.
+
+    Parameters
+    ----------
+    pH : array-like
+        pH on from_scale.
+    factors : dict
+        Conversion factors from calc_pH_scale_factors.
+    from_scale, to_scale : str
+        One of 'total', 'free', 'seawater' or 'NBS'.
+
+    Returns
+    -------
+    array-like
+        pH on to_scale.
+    """
+    _check_scale(from_scale, factors)
+    _check_scale(to_scale, factors)
+    factor = factors[to_scale] / factors[from_scale]
+    xp = get_namespace(pH, factor)
+    return pH - xp.log10(factor)
+
+def convert_K_scale(Ks, factors, from_scale='total', to_scale='free'):
+    """Convert Ks between pH scales.
+
+    Ks that do not depend on pH scale (see SCALE_DEPENDENT_KS) are
+    returned unchanged.
+
+    Parameters
+    ----------
+    Ks : dict
+        Ks on from_scale, as returned by calc_Ks.
+    factors : dict
+        Conversion factors from calc_pH_scale_factors.
+    from_scale, to_scale : str
+        One of 'total', 'free', 'seawater' or 'NBS'.
+
+    Returns
+    -------
+    dict
+        Containing Ks on to_scale.
+    """
+    _check_scale(from_scale, factors)
+    _check_scale(to_scale, factors)
+    if from_scale == to_scale:
+        return dict(Ks)
+    factor = factors[to_scale] / factors[from_scale]
+    return {k: v * factor if k in SCALE_DEPENDENT_KS else v for k, v in Ks.items()}
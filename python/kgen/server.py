@@ -0,0 +1,270 @@
+"""
+A local micro-batching service for many small, concurrent K requests.
+
+Requests that arrive within a short time window are coalesced into a
+single vectorised call to calc_Ks, and the results are split back out to
+each caller. This amortises the per-call overhead of calc_Ks (and the
+MyAMI seawater correction) across requests. Only requests that need the
+same pressure and seawater corrections are batched together, so results
+do not depend on the other requests in a batch.
+
+KBatcher can be used directly from asyncio code, or exposed over a TCP
+or Unix socket with start_server, using a newline-delimited JSON
+protocol: each request line is a JSON object of calc_Ks keyword
+arguments (plus an optional "id"), and each response line is a JSON
+object containing "id" and either "Ks" or "error". A request of
+{"metrics": true} returns the batcher metrics.
+"""
+import json
+import asyncio
+from collections import deque, namedtuple
+import numpy as np
+from .K_functions import K_fns, _calc_Ks, _calc_Ks_arguments, _needs_seawater_correction, _needs_pressure_correction, calc_sulphate, calc_fluorine
+
+INPUT_NAMES = ('temp_c', 'sal', 'p_bar', 'magnesium', 'calcium', 'sulphate', 'fluorine')
+
+_Request = namedtuple('_Request', ['key', 'inputs', 'shape', 'size', 'future'])
+
+class KBatcher:
+    """Coalesce concurrent calc_Ks requests into batched calls.
+
+    Parameters
+    ----------
+    max_batch_size : int
+        Maximum number of points to accumulate before a batch is
+        calculated. A single request larger than this is calculated
+        on its own.
+    max_latency : float
+        Maximum time in seconds to wait for further requests after the
+        first request of a batch arrives.
+    executor : concurrent.futures.Executor
+        Executor used to run calc_Ks. If None, the event loop's default
+        executor is used.
+    history : int
+        Number of recent batch sizes to keep for metrics.
+    """
+
+    def __init__(self, max_batch_size=100000, max_latency=0.005, executor=None, history=1000):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.executor = executor
+        self._queue = None
+        self._worker = None
+        self._batch = []
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_points = 0
+        self.batch_sizes = deque(maxlen=history)
+
+    async def start(self):
+        """Start the background batching task."""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the background batching task.
+
+        Requests that are queued or being calculated fail with a
+        RuntimeError.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+            unfinished = list(self._batch)
+            while not self._queue.empty():
+                unfinished.append(self._queue.get_nowait())
+            for r in unfinished:
+                if not r.future.done():
+                    r.future.set_exception(RuntimeError('KBatcher was closed before the request was calculated'))
+            self._batch = []
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    @property
+    def metrics(self):
+        """dict : Current queue depth and batch statistics."""
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'n_requests': self.n_requests,
+            'n_batches': self.n_batches,
+            'n_points': self.n_points,
+            'mean_batch_size': self.n_points / self.n_batches if self.n_batches else 0.0,
+            'max_batch_size': max(self.batch_sizes, default=0),
+            'recent_batch_sizes': list(self.batch_sizes),
+        }
+
+    async def calc_Ks(self, K_list=None, temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0528171, calcium=0.0102821, sulphate=None, fluorine=None, MyAMI_mode='calculate', MyAMI_tolerance=0.001, pH_scale='total'):
+        """
+        Calculate Ks as in calc_Ks, batched with other concurrent requests.
+
+        Parameters are as in calc_Ks.
+
+        Returns
+        -------
+        dict
+            Containing calculated Ks, with the broadcast shape of the inputs.
+        """
+        await self.start()
+
+        if K_list is None:
+            K_list = K_fns.keys()
+        if temp_c is None:
+            temp_c = 25.0
+        if sal is None:
+            sal = 35.0
+        if p_bar is None:
+            p_bar = 0.0
+        if magnesium is None:
+            magnesium = 0.0528171
+        if calcium is None:
+            calcium = 0.0102821
+        if sulphate is None:
+            sulphate = calc_sulphate(sal=np.asarray(sal, dtype=float))
+        if fluorine is None:
+            fluorine = calc_fluorine(sal=np.asarray(sal, dtype=float))
+
+        arrays = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (temp_c, sal, p_bar, magnesium, calcium, sulphate, fluorine)])
+        shape = arrays[0].shape
+        inputs = {k: v.ravel() for k, v in zip(INPUT_NAMES, arrays)}
+
+        # Requests are only batched with others that need the same corrections,
+        # so that each result is the same as calling calc_Ks on the request alone.
+        seawater = _needs_seawater_correction(inputs['magnesium'], inputs['calcium'])
+        pressure = _needs_pressure_correction(inputs['p_bar'])
+
+        future = asyncio.get_running_loop().create_future()
+        key = (tuple(K_list), MyAMI_mode, MyAMI_tolerance, pH_scale, seawater, pressure)
+        self.n_requests += 1
+        await self._queue.put(_Request(key, inputs, shape, arrays[0].size, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._batch = batch = [await self._queue.get()]
+            n = batch[0].size
+            deadline = loop.time() + self.max_latency
+            while n < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(request)
+                n += request.size
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.key, []).append(request)
+
+            for (K_list, MyAMI_mode, MyAMI_tolerance, pH_scale, seawater, pressure), requests in groups.items():
+                await self._calculate(loop, list(K_list), MyAMI_mode, MyAMI_tolerance, pH_scale, seawater, pressure, requests)
+            self._batch = []
+
+    async def _calculate(self, loop, K_list, MyAMI_mode, MyAMI_tolerance, pH_scale, seawater, pressure, requests):
+        inputs = {k: np.concatenate([r.inputs[k] for r in requests]) for k in INPUT_NAMES}
+        size = sum(r.size for r in requests)
+        self.n_batches += 1
+        self.n_points += size
+        self.batch_sizes.append(size)
+
+        try:
+            inputs, options = _calc_Ks_arguments(**inputs, MyAMI_mode=MyAMI_mode, MyAMI_tolerance=MyAMI_tolerance, pH_scale=pH_scale, coefficient_sets=None, seawater=seawater, pressure=pressure)
+            Ks = await loop.run_in_executor(self.executor, lambda: _calc_Ks(K_list, **inputs, **options))
+        except Exception as e:
+            for r in requests:
+                if not r.future.done():
+                    r.future.set_exception(e)
+            return
+
+        start = 0
+        for r in requests:
+            stop = start + r.size
+            if not r.future.done():
+                r.future.set_result({k: np.broadcast_to(v, (size,))[start:stop].reshape(r.shape) for k, v in Ks.items()})
+            start = stop
+
+async def _handle_connection(batcher, reader, writer):
+    tasks = set()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            task = asyncio.create_task(_respond(batcher, line, writer))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        writer.close()
+
+async def _respond(batcher, line, writer):
+    request_id = None
+    try:
+        kwargs = json.loads(line)
+        request_id = kwargs.pop('id', None)
+        if kwargs.pop('metrics', False):
+            response = {'metrics': batcher.metrics}
+        else:
+            Ks = await batcher.calc_Ks(**kwargs)
+            response = {'Ks': {k: v.tolist() for k, v in Ks.items()}}
+    except Exception as e:
+        response = {'error': f'{type(e).__name__}: {e}'}
+    response['id'] = request_id
+    writer.write((json.dumps(response) + '\n').encode())
+    await writer.drain()
+
+async def start_server(batcher=None, host='127.0.0.1', port=0, path=None, **kwargs):
+    """
+    Start a local newline-delimited JSON server wrapping a KBatcher.
+
+    Parameters
+    ----------
+    batcher : KBatcher
+        The batcher to use. If None, one is created using **kwargs.
+    host, port : str, int
+        Address to listen on for TCP connections. Port 0 picks a free port.
+    path : str
+        If given, listen on this Unix socket path instead of TCP.
+
+    Returns
+    -------
+    asyncio.base_events.Server
+        The running server. The batcher is available as `server.batcher`.
+    """
+    if batcher is None:
+        batcher = KBatcher(**kwargs)
+    await batcher.start()
+
+    def handler(reader, writer):
+        return _handle_connection(batcher, reader, writer)
+
+    if path is not None:
+        server = await asyncio.start_unix_server(handler, path=path)
+    else:
+        server = await asyncio.start_server(handler, host=host, port=port)
+    server.batcher = batcher
+    return server
+
+async def serve(host='127.0.0.1', port=8765, path=None, **kwargs):
+    """Run a KBatcher server until cancelled. See start_server."""
+    server = await start_server(host=host, port=port, path=path, **kwargs)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await server.batcher.close()
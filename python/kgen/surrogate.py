@@ -0,0 +1,247 @@
+"""
+Piecewise polynomial surrogates of calc_Ks for fast evaluation within a fixed domain.
+
+fit_surrogate evaluates calc_Ks (including the pressure and MyAMI
+corrections) at sample points within a declared (temp_c, sal, p_bar,
+magnesium, calcium) domain, and fits ln(K) in each piece of the domain
+with a total-degree Chebyshev polynomial. Evaluating the surrogate costs
+one row of Chebyshev basis functions per point, shared by all Ks, and a
+dot product of that row with the coefficients of each K.
+
+The maximum relative error of each K is estimated against calc_Ks at
+independent points when the surrogate is fitted, and is saved with it.
+Points outside the domain are refused.
+"""
+import json
+from itertools import product
+import numpy as np
+from numpy.polynomial import chebyshev
+from .K_functions import K_fns, calc_Ks
+
+DIMENSIONS = ('temp_c', 'sal', 'p_bar', 'magnesium', 'calcium')
+DEFAULTS = {'temp_c': 25.0, 'sal': 35.0, 'p_bar': 0.0, 'magnesium': 0.0528171, 'calcium': 0.0102821}
+
+def calc_total_degree_powers(n_dims, degree):
+    """Powers of all polynomial terms in n_dims dimensions with total degree <= degree.
+
+    Returns
+    -------
+    np.ndarray
+        Of shape (n_terms, n_dims).
+    """
+    powers = [p for p in product(range(degree + 1), repeat=n_dims) if sum(p) <= degree]
+    return np.array(powers, dtype=int).reshape(len(powers), n_dims)
+
+class KSurrogate:
+    """Piecewise Chebyshev surrogate of calc_Ks, as returned by fit_surrogate.
+
+    Call with temp_c, sal, p_bar, magnesium and calcium (as in calc_Ks)
+    to calculate Ks. Inputs that are not given take the calc_Ks defaults,
+    and every input must lie within the domain.
+
+    Attributes
+    ----------
+    K_list : list
+        Ks represented by the surrogate.
+    domain : dict
+        (lower, upper) bounds of each input. Inputs with equal bounds are
+        fixed.
+    pieces : dict
+        Number of equal pieces along each varying input.
+    degree : int
+        Total degree of the polynomial in each piece.
+    max_rel_error : dict
+        Maximum relative error of each K found at the validation points
+        when fitting. This is an estimate, which may be slightly exceeded
+        elsewhere in the domain.
+    options : dict
+        MyAMI_mode, MyAMI_tolerance and pH_scale passed to calc_Ks.
+    """
+    def __init__(self, K_list, domain, pieces, degree, coefficients, max_rel_error, options):
+        self.K_list = list(K_list)
+        self.domain = {k: (float(domain[k][0]), float(domain[k][1])) for k in DIMENSIONS}
+        self.variables = [k for k in DIMENSIONS if self.domain[k][0] != self.domain[k][1]]
+        self.pieces = {k: int(pieces.get(k, 1)) for k in self.variables}
+        self.degree = int(degree)
+        self.powers = calc_total_degree_powers(len(self.variables), self.degree)
+        self.coefficients = coefficients  # (n_pieces, n_terms, n_Ks), for ln(K)
+        self.max_rel_error = dict(max_rel_error)
+        self.options = dict(options)
+
+    @property
+    def n_pieces(self):
+        return int(np.prod([self.pieces[k] for k in self.variables]))
+
+    def _locate(self, x):
+        # Index of the piece containing each point, and its coordinates within that piece scaled to [-1, 1]
+        index = 0
+        coords = []
+        for k in self.variables:
+            lower, upper = self.domain[k]
+            u = (x[k] - lower) / (upper - lower) * self.pieces[k]
+            i = np.minimum(np.floor(u), self.pieces[k] - 1)
+            index = index * self.pieces[k] + i.astype(int)
+            coords.append(2 * (u - i) - 1)
+        return index, coords
+
+    def _basis(self, coords, n):
+        # Chebyshev basis functions of every polynomial term, shape (n_terms, n)
+        basis = np.ones((len(self.powers), n))
+        for d, c in enumerate(coords):
+            basis *= np.ascontiguousarray(chebyshev.chebvander(c, self.degree).T)[self.powers[:, d]]
+        return basis
+
+    def __call__(self, temp_c=None, sal=None, p_bar=None, magnesium=None, calcium=None, chunk_size=2**14):
+        """Calculate Ks from the surrogate.
+
+        Parameters
+        ----------
+        temp_c, sal, p_bar, magnesium, calcium : array-like
+            As in calc_Ks. Must lie within the surrogate domain.
+        chunk_size : int
+            Number of points evaluated at a time.
+
+        Returns
+        -------
+        dict
+            Containing calculated Ks.
+        """
+        inputs = {}
+        for k, v in zip(DIMENSIONS, (temp_c, sal, p_bar, magnesium, calcium)):
+            v = np.asarray(DEFAULTS[k] if v is None else v, dtype=float)
+            lower, upper = self.domain[k]
+            if not np.all((v >= lower) & (v <= upper)):
+                raise ValueError(f'{k} is outside the surrogate domain [{lower}, {upper}]')
+            inputs[k] = v
+
+        shape = np.broadcast_shapes(*[v.shape for v in inputs.values()])
+        size = int(np.prod(shape))
+        ln_Ks = np.empty((len(self.K_list), size))
+        for start in range(0, size, chunk_size):
+            stop = min(start + chunk_size, size)
+            index, coords = self._locate({k: np.broadcast_to(inputs[k], shape).flat[start:stop] for k in self.variables})
+            # sort the points by piece, so that each piece is one matrix product
+            order = np.argsort(np.broadcast_to(index, (stop - start,)), kind='stable')
+            index = np.broadcast_to(index, (stop - start,))[order]
+            basis = self._basis([c[order] for c in coords], stop - start)
+            splits = np.flatnonzero(np.diff(index)) + 1
+            ln_K = np.empty((len(self.K_list), stop - start))
+            for a, b in zip(np.r_[0, splits], np.r_[splits, stop - start]):
+                ln_K[:, a:b] = self.coefficients[index[a]].T @ basis[:, a:b]
+            ln_Ks[:, start + order] = ln_K
+
+        np.exp(ln_Ks, out=ln_Ks)
+        return {k: ln_Ks[i].reshape(shape) for i, k in enumerate(self.K_list)}
+
+    def save(self, path):
+        """Save the surrogate to a compressed .npz file."""
+        metadata = {
+            'K_list': self.K_list,
+            'domain': self.domain,
+            'pieces': self.pieces,
+            'degree': self.degree,
+            'max_rel_error': self.max_rel_error,
+            'options': self.options,
+        }
+        np.savez_compressed(path, coefficients=self.coefficients, metadata=json.dumps(metadata))
+
+def load_surrogate(path):
+    """Load a surrogate saved with KSurrogate.save.
+
+    Parameters
+    ----------
+    path : str or os.PathLike
+        Path to the .npz file.
+
+    Returns
+    -------
+    KSurrogate
+    """
+    with np.load(path) as f:
+        metadata = json.loads(str(f['metadata']))
+        return KSurrogate(coefficients=f['coefficients'], **metadata)
+
+def fit_surrogate(domain, K_list=None, degree=6, pieces=None, MyAMI_mode='calculate', MyAMI_tolerance=0.001, pH_scale='total', oversample=3, n_validate=10000, seed=0):
+    """
+    Fit a piecewise Chebyshev surrogate of calc_Ks over a domain.
+
+    In each piece, ln(K) is fitted by least squares to calc_Ks at
+    oversample times as many points as there are polynomial terms,
+    sampled with Chebyshev density. The maximum relative error of each K
+    is then estimated at n_validate uniformly sampled points.
+
+    Parameters
+    ----------
+    domain : dict
+        (lower, upper) bounds of any of 'temp_c', 'sal', 'p_bar',
+        'magnesium' and 'calcium', or a single value to fix an input.
+        Inputs that are not given are fixed at the calc_Ks defaults.
+    K_list : array-like
+        List of Ks to fit. All Ks if None.
+    degree : int
+        Total degree of the polynomial in each piece. The number of terms
+        (and the cost of evaluation) grows as
+        (degree + n_inputs)! / (degree! n_inputs!).
+    pieces : dict
+        Number of equal pieces to split each varying input into. 1 if
+        not given.
+    MyAMI_mode, MyAMI_tolerance, pH_scale
+        As in calc_Ks.
+    oversample : float
+        Ratio of fitting points to polynomial terms in each piece.
+    n_validate : int
+        Number of points at which the error is estimated.
+    seed : int
+        Seed for the sample points.
+
+    Returns
+    -------
+    KSurrogate
+        With the estimated maximum relative error of each K in
+        max_rel_error.
+    """
+    if K_list is None:
+        K_list = K_fns.keys()
+    if pieces is None:
+        pieces = {}
+
+    unknown = set(domain) - set(DIMENSIONS)
+    if unknown:
+        raise ValueError(f'Unknown domain inputs {sorted(unknown)} - must be any of {DIMENSIONS}')
+    bounds = {}
+    for k in DIMENSIONS:
+        v = domain.get(k, DEFAULTS[k])
+        lower, upper = (v, v) if np.ndim(v) == 0 else v
+        if not lower <= upper:
+            raise ValueError(f'Lower bound of {k} is above its upper bound')
+        bounds[k] = (lower, upper)
+
+    options = {'MyAMI_mode': MyAMI_mode, 'MyAMI_tolerance': MyAMI_tolerance, 'pH_scale': pH_scale}
+    surrogate = KSurrogate(K_list, bounds, pieces, degree, coefficients=None, max_rel_error={}, options=options)
+    fixed = {k: surrogate.domain[k][0] for k in DIMENSIONS if k not in surrogate.variables}
+    n_vars, (n_terms, _) = len(surrogate.variables), surrogate.powers.shape
+    rng = np.random.default_rng(seed)
+
+    # Chebyshev-distributed points in every piece, in a single calc_Ks call
+    n_fit = int(np.ceil(oversample * n_terms))
+    coords = np.cos(np.pi * rng.random((surrogate.n_pieces, n_fit, n_vars)))
+    piece_index = np.array(list(product(*[range(surrogate.pieces[k]) for k in surrogate.variables])), dtype=float).reshape(surrogate.n_pieces, 1, n_vars)
+    x = {}
+    for d, k in enumerate(surrogate.variables):
+        lower, upper = surrogate.domain[k]
+        x[k] = (lower + (piece_index[..., d] + (coords[..., d] + 1) / 2) * (upper - lower) / surrogate.pieces[k]).ravel()
+    Ks = calc_Ks(K_list=surrogate.K_list, **x, **fixed, **options)
+    ln_Ks = np.stack([np.log(np.broadcast_to(Ks[k], (surrogate.n_pieces * n_fit,))) for k in surrogate.K_list], axis=-1)
+    ln_Ks = ln_Ks.reshape(surrogate.n_pieces, n_fit, len(surrogate.K_list))
+
+    surrogate.coefficients = np.empty((surrogate.n_pieces, n_terms, len(surrogate.K_list)))
+    for p in range(surrogate.n_pieces):
+        basis = surrogate._basis([coords[p, :, d] for d in range(n_vars)], n_fit)
+        surrogate.coefficients[p] = np.linalg.lstsq(basis.T, ln_Ks[p], rcond=None)[0]
+
+    x = {k: rng.uniform(*surrogate.domain[k], n_validate) for k in surrogate.variables}
+    Ks = calc_Ks(K_list=surrogate.K_list, **x, **fixed, **options)
+    approximated = surrogate(**x, **fixed)
+    surrogate.max_rel_error = {k: float(np.max(np.abs(approximated[k] / Ks[k] - 1))) for k in surrogate.K_list}
+
+    return surrogate
@@ -0,0 +1,162 @@
+"""
+Monte Carlo propagation of input uncertainties through calc_Ks.
+
+The ensemble of perturbed inputs is evaluated as batched
+(n_samples x n_points) calls to calc_Ks, in chunks of samples that may be
+run in parallel, and summarised with streaming statistics so that the
+individual samples are never all held in memory.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .K_functions import K_fns, calc_Ks
+
+INPUT_NAMES = ('temp_c', 'sal', 'p_bar', 'magnesium', 'calcium', 'sulphate', 'fluorine')
+
+class Normal:
+    """Normal distribution for Monte Carlo inputs.
+
+    Parameters
+    ----------
+    mean, sd : array-like
+        Mean and standard deviation, broadcast against the other inputs.
+    """
+    def __init__(self, mean, sd):
+        self.mean = np.asarray(mean, dtype=float)
+        self.sd = np.asarray(sd, dtype=float)
+
+    @property
+    def shape(self):
+        return np.broadcast_shapes(self.mean.shape, self.sd.shape)
+
+    def rvs(self, size, random_state):
+        return random_state.normal(self.mean, self.sd, size=size)
+
+class Uniform:
+    """Uniform distribution for Monte Carlo inputs.
+
+    Parameters
+    ----------
+    low, high : array-like
+        Lower and upper bounds, broadcast against the other inputs.
+    """
+    def __init__(self, low, high):
+        self.low = np.asarray(low, dtype=float)
+        self.high = np.asarray(high, dtype=float)
+
+    @property
+    def shape(self):
+        return np.broadcast_shapes(self.low.shape, self.high.shape)
+
+    def rvs(self, size, random_state):
+        return random_state.uniform(self.low, self.high, size=size)
+
+def _is_distribution(x):
+    return hasattr(x, 'rvs')
+
+class _Summary:
+    # Streaming mean, variance, min and max (Chan et al. parallel algorithm)
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    def update(self, samples):
+        n = samples.shape[0]
+        mean = samples.mean(axis=0)
+        m2 = ((samples - mean) ** 2).sum(axis=0)
+        delta = mean - self.mean
+        total = self.n + n
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.n * n / total
+        self.n = total
+        self.min = np.minimum(self.min, samples.min(axis=0))
+        self.max = np.maximum(self.max, samples.max(axis=0))
+
+    def result(self):
+        return {
+            'mean': self.mean,
+            'std': np.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else np.zeros_like(self.mean),
+            'min': self.min,
+            'max': self.max,
+            'n': self.n,
+        }
+
+def calc_Ks_montecarlo(n_samples, K_list=None, temp_c=25.0, sal=35.0, p_bar=0.0, magnesium=0.0528171, calcium=0.0102821, sulphate=None, fluorine=None, MyAMI_mode='calculate', MyAMI_tolerance=0.001, pH_scale='total', chunk_size=1000, n_workers=1, seed=None):
+    """
+    Propagate input uncertainties through calc_Ks by Monte Carlo.
+
+    Each input may be fixed (array-like or scalar) or a distribution: any
+    object with an `rvs(size, random_state)` method, such as `Normal`
+    and `Uniform` or a frozen scipy.stats distribution. Samples
+    are drawn independently for every point and evaluated chunk_size
+    samples at a time as a single (chunk_size x n_points) calc_Ks call.
+
+    Parameters
+    ----------
+    n_samples : int
+        Number of Monte Carlo samples.
+    K_list, MyAMI_mode, MyAMI_tolerance, pH_scale
+        As in calc_Ks. Using MyAMI_mode='approximate' or 'auto' avoids
+        running the full MyAMI model on every sample.
+    temp_c, sal, p_bar, magnesium, calcium, sulphate, fluorine : array-like or distribution
+        Inputs as in calc_Ks, or distributions to sample them from.
+    chunk_size : int
+        Number of samples evaluated in each calc_Ks call.
+    n_workers : int
+        Number of chunks evaluated in parallel threads. All MyAMI_modes
+        are thread-safe - in 'auto' mode, the warning filters are only
+        changed by one thread at a time.
+    seed : int or np.random.SeedSequence
+        Seed for reproducible sampling. Each chunk uses an independent
+        stream spawned from this seed, so results do not depend on
+        n_workers.
+
+    Returns
+    -------
+    dict
+        Containing, for each K, a dict of 'mean', 'std', 'min' and 'max'
+        over the samples (with the broadcast shape of the inputs) and
+        the number of samples 'n'.
+    """
+    if K_list is None:
+        K_list = K_fns.keys()
+    if temp_c is None:
+        temp_c = 25.0
+    if sal is None:
+        sal = 35.0
+    if p_bar is None:
+        p_bar = 0.0
+
+    inputs = {k: v for k, v in zip(INPUT_NAMES, (temp_c, sal, p_bar, magnesium, calcium, sulphate, fluorine)) if v is not None}
+    shape = np.broadcast_shapes(*[v.shape if _is_distribution(v) else np.shape(v) for v in inputs.values()])
+
+    chunks = [min(chunk_size, n_samples - start) for start in range(0, n_samples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+
+    def evaluate(n, seed):
+        rng = np.random.default_rng(seed)
+        sampled = {}
+        for k, v in inputs.items():
+            if _is_distribution(v):
+                sampled[k] = v.rvs(size=(n,) + shape, random_state=rng)
+            else:
+                sampled[k] = np.broadcast_to(v, (n,) + shape)
+        Ks = calc_Ks(K_list=K_list, MyAMI_mode=MyAMI_mode, MyAMI_tolerance=MyAMI_tolerance, pH_scale=pH_scale, **sampled)
+        return {k: np.broadcast_to(v, (n,) + shape) for k, v in Ks.items()}
+
+    summaries = {k: _Summary(shape) for k in K_list}
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # submit at most n_workers chunks ahead, so only those samples are held in memory
+        pending = []
+        for n, s in zip(chunks, seeds):
+            pending.append(executor.submit(evaluate, n, s))
+            if len(pending) >= n_workers:
+                for k, v in pending.pop(0).result().items():
+                    summaries[k].update(v)
+        for future in pending:
+            for k, v in future.result().items():
+                summaries[k].update(v)
+
+    return {k: s.result() for k, s in summaries.items()}
@@ -2,6 +2,6 @@ from setuptools import setup, find_packages
 
 setup(
     packages=find_packages(),
-    package_data={'kgen': ['coefficients/*.json']},
+    package_data={'kgen': ['coefficients/*.json', '*.json']},
     include_package_data=True,
     zip_safe=True)
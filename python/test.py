@@ -1,8 +1,35 @@
 import unittest
 import json
 import os
+import asyncio
+import tempfile
+import warnings
+import mmap
+import tracemalloc
 import numpy as np
-from kgen.K_functions import K_fns, calc_pressure_correction, calc_Ks
+from kgen.K_functions import K_fns, calc_pressure_correction, calc_K, calc_Ks, calc_seawater_correction, calc_sulphate, calc_fluorine
+from kgen.coefs import K_coefs, K_presscorr_coefs, register_coefficient_set, coefficient_sets
+from kgen.out_of_core import calc_Ks_memmap, page_aligned_chunks
+from kgen.server import KBatcher, start_server
+from kgen.incremental import IncrementalKs
+from kgen.approximation_error import calc_approximation_error
+from kgen.derivatives import calc_Ks_jacobian, dK_fns
+from kgen.uncertainty import calc_Ks_montecarlo, Normal, Uniform
+from kgen.carbonate import calc_carbonate_system, CARBONATE_KS
+from kgen.pH_scales import calc_pH_scale_factors, convert_pH_scale, convert_K_scale, SCALE_DEPENDENT_KS
+from kgen.surrogate import fit_surrogate, load_surrogate
+
+try:
+    import jax
+    import jax.numpy as jnp
+    from jax.experimental import enable_x64
+except ImportError:
+    jax = None
+
+try:
+    import torch
+except ImportError:
+    torch = None
 
 # boilerplate to deal with file paths
 cwd = os.getcwd()
@@ -83,6 +110,621 @@ class checkKValues(unittest.TestCase):
         output = calc_Ks(temp_c=30.0,sal=36.0,p_bar=2.0,calcium=0.01,magnesium=0.05) # Standard call plus pressure and magnesium and calcium
         output = calc_Ks(temp_c=30.0,sal=36.0,p_bar=2.0,calcium=None,magnesium=None) # Standard call plus pressure and magnesium and calcium as None
 
+
+class checkOutOfCore(unittest.TestCase):
+    """
+    Test out-of-core calculation against in-memory calc_Ks.
+    """
+
+    def test_memmap(self):
+        rng = np.random.default_rng(26)
+        shape = (30, 100)
+        inputs = {
+            'temp_c': rng.uniform(0, 40, shape),
+            'sal': rng.uniform(30, 40, shape),
+            'p_bar': rng.uniform(0, 500, shape),
+            'magnesium': rng.uniform(0.03, 0.06, shape),
+        }
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = {}
+            for k, v in inputs.items():
+                paths[k] = os.path.join(tmp, f'{k}.npy')
+                np.save(paths[k], v)
+            # raw binary input via np.memmap
+            inputs['calcium'] = rng.uniform(0.005, 0.02, shape)
+            inputs['calcium'].tofile(os.path.join(tmp, 'calcium.bin'))
+            paths['calcium'] = np.memmap(os.path.join(tmp, 'calcium.bin'), dtype=np.float64, mode='r', shape=shape)
+
+            out = calc_Ks_memmap(os.path.join(tmp, 'out'), chunk_size=1000, **paths)
+            ref = calc_Ks(**inputs)
+
+            for k in ref:
+                self.assertIsInstance(out[k], np.memmap)
+                np.testing.assert_allclose(np.load(os.path.join(tmp, 'out', f'{k}.npy')), ref[k], rtol=1e-12, err_msg=k)
+            del out
+
+    def test_memmap_corrections(self):
+        # chunks that are all modern seawater or at the surface are corrected as the whole dataset is
+        magnesium = np.full(4096, 0.0528171)
+        magnesium[-1] = 0.04
+        p_bar = np.zeros(4096)
+        p_bar[-1] = 100.
+        with tempfile.TemporaryDirectory() as tmp:
+            out = calc_Ks_memmap(tmp, chunk_size=1024, magnesium=magnesium, p_bar=p_bar, MyAMI_mode='approximate')
+            ref = calc_Ks(magnesium=magnesium, p_bar=p_bar, MyAMI_mode='approximate')
+            for k in ref:
+                np.testing.assert_allclose(out[k], ref[k], rtol=1e-12, err_msg=k)
+            del out
+
+    def test_page_aligned_chunks(self):
+        chunks = list(page_aligned_chunks(10000, 1024, 8, offset=128))
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], 10000)
+        for (_, stop), (start, _) in zip(chunks[:-1], chunks[1:]):
+            self.assertEqual(stop, start)
+            self.assertEqual((128 + start * 8) % mmap.PAGESIZE, 0)
+
+    def test_memmap_shapes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(ValueError):
+                calc_Ks_memmap(tmp, temp_c=np.ones(3), sal=np.ones(4))
+
+
+class checkServer(unittest.TestCase):
+    """
+    Test batched calculation of concurrent requests.
+    """
+
+    def test_batcher(self):
+        rng = np.random.default_rng(27)
+        requests = [dict(temp_c=rng.uniform(0, 40, 3), sal=rng.uniform(30, 40, 3), p_bar=rng.uniform(0, 100)) for _ in range(20)]
+
+        async def run():
+            async with KBatcher(max_batch_size=1000, max_latency=0.05) as batcher:
+                results = await asyncio.gather(*[batcher.calc_Ks(**r) for r in requests])
+                return results, batcher.metrics
+
+        results, metrics = asyncio.run(run())
+
+        self.assertEqual(metrics['n_requests'], 20)
+        self.assertLess(metrics['n_batches'], 20)
+        self.assertEqual(metrics['n_points'], 60)
+        for r, Ks in zip(requests, results):
+            ref = calc_Ks(**r)
+            for k in ref:
+                np.testing.assert_allclose(Ks[k], ref[k], rtol=1e-12, err_msg=k)
+
+    def test_batcher_corrections(self):
+        # a modern seawater request is not corrected because it shares a batch with a non-modern one
+        requests = [dict(temp_c=np.array([5., 15.]), MyAMI_mode='approximate'), dict(temp_c=10., magnesium=0.04, MyAMI_mode='approximate')]
+
+        async def run():
+            async with KBatcher(max_latency=0.05) as batcher:
+                return await asyncio.gather(*[batcher.calc_Ks(**r) for r in requests])
+
+        for r, Ks in zip(requests, asyncio.run(run())):
+            ref = calc_Ks(**r)
+            for k in ref:
+                np.testing.assert_allclose(Ks[k], ref[k], rtol=1e-12, err_msg=k)
+
+    def test_batcher_close(self):
+        async def run():
+            batcher = KBatcher(max_latency=10.)
+            await batcher.start()
+            pending = asyncio.ensure_future(batcher.calc_Ks(temp_c=10.))
+            await asyncio.sleep(0.01)
+            await batcher.close()
+            with self.assertRaises(RuntimeError):
+                await asyncio.wait_for(pending, 1.)
+
+        asyncio.run(run())
+
+    def test_server(self):
+        async def run():
+            server = await start_server(max_latency=0.01)
+            host, port = server.sockets[0].getsockname()[:2]
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(b'{"id": 1, "K_list": ["K1", "K2"], "temp_c": [10, 20], "sal": 35}\n')
+            writer.write(b'{"id": 2, "K_list": ["K1"], "temp_c": "bad"}\n')
+            await writer.drain()
+            responses = [json.loads(await reader.readline()) for _ in range(2)]
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            await server.batcher.close()
+            return {r['id']: r for r in responses}
+
+        responses = asyncio.run(run())
+
+        ref = calc_Ks(K_list=['K1', 'K2'], temp_c=np.array([10, 20]), sal=35)
+        for k in ref:
+            np.testing.assert_allclose(responses[1]['Ks'][k], ref[k], rtol=1e-12)
+        self.assertIn('error', responses[2])
+
+
+class checkIncremental(unittest.TestCase):
+    """
+    Test incremental recalculation of changed blocks.
+    """
+
+    def test_incremental(self):
+        rng = np.random.default_rng(28)
+        shape = (50, 40)
+        inputs = {
+            'temp_c': rng.uniform(0, 40, shape),
+            'sal': rng.uniform(30, 40, shape),
+            'p_bar': rng.uniform(0, 500, shape),
+            'magnesium': rng.uniform(0.03, 0.06, shape),
+        }
+        cache = IncrementalKs(block_size=100)
+
+        Ks = cache.calc_Ks('field', **inputs)
+        self.assertEqual(cache.last_recomputed, 2000)
+
+        inputs['temp_c'][10, 5] += 1.0
+        inputs['magnesium'][40, 0] = 0.04
+        Ks = cache.calc_Ks('field', **inputs)
+        self.assertEqual(cache.last_recomputed, 200)
+
+        ref = calc_Ks(**inputs)
+        for k in ref:
+            np.testing.assert_allclose(Ks[k], ref[k], rtol=1e-12, err_msg=k)
+
+        Ks = cache.calc_Ks('field', **inputs)
+        self.assertEqual(cache.last_recomputed, 0)
+
+    def test_incremental_corrections(self):
+        # changed blocks of modern seawater are corrected as the whole field is
+        magnesium = np.full(400, 0.0528171)
+        magnesium[-1] = 0.04
+        inputs = {'temp_c': np.linspace(0, 30, 400), 'magnesium': magnesium, 'MyAMI_mode': 'approximate'}
+        cache = IncrementalKs(block_size=100)
+        cache.calc_Ks('field', **inputs)
+        inputs['temp_c'][0] += 1.0
+        Ks = cache.calc_Ks('field', **inputs)
+        self.assertEqual(cache.last_recomputed, 100)
+        ref = calc_Ks(**inputs)
+        for k in ref:
+            np.testing.assert_allclose(Ks[k], ref[k], rtol=1e-12, err_msg=k)
+
+        # when the field no longer needs the seawater correction, every block is recalculated
+        inputs['magnesium'] = 0.0528171
+        Ks = cache.calc_Ks('field', **inputs)
+        self.assertEqual(cache.last_recomputed, 400)
+        ref = calc_Ks(**inputs)
+        for k in ref:
+            np.testing.assert_allclose(Ks[k], ref[k], rtol=1e-12, err_msg=k)
+
+        # magnesium and calcium of None are modern, as in calc_Ks
+        Ks = cache.calc_Ks('none', temp_c=10., magnesium=None, calcium=None)
+        ref = calc_Ks(temp_c=10.)
+        for k in ref:
+            np.testing.assert_allclose(Ks[k], ref[k], rtol=1e-12, err_msg=k)
+
+    def test_eviction(self):
+        cache = IncrementalKs(block_size=10, max_memory=15000)
+        cache.calc_Ks('a', temp_c=np.linspace(0, 40, 100))
+        cache.calc_Ks('b', temp_c=np.linspace(0, 40, 100))
+        self.assertNotIn('a', cache)
+        self.assertIn('b', cache)
+        self.assertLessEqual(cache.nbytes, 15000)
+
+
+class checkAutoMyAMI(unittest.TestCase):
+    """
+    Test 'auto' MyAMI_mode against full and approximate MyAMI.
+    """
+
+    def test_auto(self):
+        rng = np.random.default_rng(29)
+        n = 500
+        temp_c = rng.uniform(-2, 40, n)
+        sal = rng.uniform(25, 40, n)
+        magnesium = rng.uniform(0, 0.06, n)
+        calcium = rng.uniform(0, 0.06, n)
+        ks = ['K1', 'K2', 'KB', 'KW', 'KspC']
+
+        calculated = calc_seawater_correction(ks, temp_c, sal, magnesium, calcium, MyAMI_mode='calculate')
+
+        for tolerance in [1e-4, 1e-3, 5e-3]:
+            auto = calc_seawater_correction(ks, temp_c, sal, magnesium, calcium, MyAMI_mode='auto', MyAMI_tolerance=tolerance)
+            for k in ks:
+                np.testing.assert_array_less(np.abs(auto[k] / calculated[k] - 1), tolerance, err_msg=k)
+
+        # points outside the approximation domain are always calculated
+        outside = (temp_c < 0) | (sal < 30)
+        auto = calc_seawater_correction(ks, temp_c, sal, magnesium, calcium, MyAMI_mode='auto', MyAMI_tolerance=1.0)
+        for k in ks:
+            np.testing.assert_allclose(auto[k][outside], calculated[k][outside], rtol=1e-12)
+            self.assertFalse(np.allclose(auto[k][~outside], calculated[k][~outside], rtol=1e-12))
+
+    def test_auto_calc_Ks(self):
+        Ks = calc_Ks(temp_c=np.array([5., 20.]), sal=35., magnesium=0.03, calcium=0.02, MyAMI_mode='auto')
+        ref = calc_Ks(temp_c=np.array([5., 20.]), sal=35., magnesium=0.03, calcium=0.02, MyAMI_mode='calculate')
+        for k in ref:
+            np.testing.assert_allclose(Ks[k], ref[k], rtol=1e-3, err_msg=k)
+
+
+class checkDerivatives(unittest.TestCase):
+    """
+    Test analytic derivatives against central finite differences.
+    """
+
+    def test_jacobian(self):
+        rng = np.random.default_rng(30)
+        inputs = {
+            'temp_c': rng.uniform(0, 35, 5),
+            'sal': rng.uniform(30, 40, 5),
+            'p_bar': rng.uniform(0, 500, 5),
+        }
+        for kwargs in [{}, {'magnesium': 0.03, 'calcium': 0.02, 'MyAMI_mode': 'approximate'}, {'magnesium': 0.03, 'calcium': 0.02, 'MyAMI_mode': 'calculate'}]:
+            self.check_jacobian(inputs, kwargs)
+
+        # points on the edges of the cells of the MyAMI approximation error table, where
+        # 'auto' mode approximates the first point and calculates the others
+        inputs = {
+            'temp_c': np.array([5., 22., 15.]),
+            'sal': np.array([35., 35., 32.5]),
+            'p_bar': np.array([0., 100., 300.]),
+            'magnesium': np.array([0.03, 0.04, 0.05]),
+            'calcium': np.array([0.02, 0.012, 0.01]),
+        }
+        self.check_jacobian(inputs, {'MyAMI_mode': 'auto', 'MyAMI_tolerance': 3.05e-4})
+
+    def check_jacobian(self, inputs, kwargs):
+        # compare against central finite differences of calc_Ks
+        steps = {'temp_c': 1e-3, 'sal': 1e-3, 'p_bar': 1e-2}
+        Ks, jacobian = calc_Ks_jacobian(**inputs, **kwargs)
+        ref = calc_Ks(**inputs, **kwargs)
+
+        def calc_Ks_fixed_mode(**x):
+            # in 'auto' mode, each point is differentiated using the method chosen at the unperturbed point
+            if kwargs.get('MyAMI_mode') != 'auto':
+                return calc_Ks(**x, **kwargs)
+            approximate = calc_approximation_error(list(K_fns), inputs['temp_c'], inputs['sal'], inputs['magnesium'], inputs['calcium']) <= kwargs['MyAMI_tolerance']
+            approximated = calc_Ks(**x, MyAMI_mode='approximate')
+            calculated = calc_Ks(**x, MyAMI_mode='calculate')
+            return {k: np.where(approximate, approximated[k], calculated[k]) for k in calculated}
+
+        for x, h in steps.items():
+            hi = calc_Ks_fixed_mode(**{**inputs, x: inputs[x] + h})
+            lo = calc_Ks_fixed_mode(**{**inputs, x: inputs[x] - h})
+            for k in ref:
+                fd = (hi[k] - lo[k]) / (2 * h)
+                np.testing.assert_allclose(Ks[k], ref[k], rtol=1e-12, err_msg=k)
+                np.testing.assert_allclose(jacobian[k][x] / Ks[k], fd / ref[k], rtol=0, atol=1e-7, err_msg=f'{kwargs} {k} d/d{x}')
+
+    def test_K_fns(self):
+        # the derivative functions calculate the same Ks as K_fns, for scalar and array inputs
+        for temp_c, sal in [(25., 35.), (np.linspace(0, 35, 5), np.linspace(30, 40, 5))]:
+            for k in K_fns:
+                np.testing.assert_allclose(dK_fns[k](coefficients=K_coefs[k], temp_c=temp_c, sal=sal)[0], K_fns[k](coefficients=K_coefs[k], temp_c=temp_c, sal=sal), rtol=1e-12, err_msg=k)
+
+    def test_jacobian_Ks(self):
+        # Ks from calc_Ks_jacobian match calc_Ks with and without pressure, and for coefficient sets
+        temp_c = np.linspace(0, 35, 5)
+        K1 = list(K_coefs['K1'])
+        K1[0] += 0.01
+        register_coefficient_set('test_jacobian', K_calculation={'K1': K1})
+        try:
+            for kwargs in [{}, {'p_bar': np.linspace(0, 500, 5)}, {'p_bar': 100., 'coefficient_sets': ['default', 'test_jacobian']}]:
+                Ks, jacobian = calc_Ks_jacobian(temp_c=temp_c, **kwargs)
+                ref = calc_Ks(temp_c=temp_c, **kwargs)
+                for k in ref:
+                    np.testing.assert_allclose(Ks[k], ref[k], rtol=1e-12, err_msg=k)
+                    self.assertEqual(jacobian[k]['temp_c'].shape, ref[k].shape)
+        finally:
+            coefficient_sets.pop('test_jacobian')
+
+
+class checkMonteCarlo(unittest.TestCase):
+    """
+    Test Monte Carlo uncertainty propagation against linear propagation.
+    """
+
+    def test_montecarlo(self):
+        temp_c = np.array([5., 15., 25.])
+        sal = 35.
+        p_bar = np.array([0., 100., 300.])
+        temp_sd, sal_sd = 0.5, 0.2
+
+        mc = calc_Ks_montecarlo(4000, temp_c=Normal(temp_c, temp_sd), sal=Normal(sal, sal_sd), p_bar=p_bar, chunk_size=1000, n_workers=2, seed=31)
+        Ks, jacobian = calc_Ks_jacobian(temp_c=temp_c, sal=sal, p_bar=p_bar)
+
+        for k in Ks:
+            self.assertEqual(mc[k]['n'], 4000)
+            self.assertEqual(mc[k]['mean'].shape, (3,))
+            linear_sd = np.sqrt((jacobian[k]['temp_c'] * temp_sd) ** 2 + (jacobian[k]['sal'] * sal_sd) ** 2)
+            np.testing.assert_allclose(mc[k]['mean'], Ks[k], rtol=0.01, err_msg=k)
+            np.testing.assert_allclose(mc[k]['std'], linear_sd, rtol=0.1, err_msg=k)
+
+    def test_reproducible(self):
+        kwargs = dict(K_list=['K1', 'KB'], temp_c=Uniform(0, 30), sal=Normal(35, 1), chunk_size=100, seed=1)
+        a = calc_Ks_montecarlo(500, n_workers=1, **kwargs)
+        b = calc_Ks_montecarlo(500, n_workers=3, **kwargs)
+        for k in a:
+            np.testing.assert_allclose(a[k]['mean'], b[k]['mean'], rtol=1e-12)
+            np.testing.assert_allclose(a[k]['std'], b[k]['std'], rtol=1e-12)
+
+    def test_threads_warning_filters(self):
+        # concurrent 'auto' mode chunks leave the process warning filters unchanged
+        filters = list(warnings.filters)
+        calc_Ks_montecarlo(64, K_list=['K1'], temp_c=Normal(np.linspace(5, 25, 50), 1.), magnesium=Uniform(0.03, 0.05), MyAMI_mode='auto', MyAMI_tolerance=1., chunk_size=4, n_workers=8, seed=31)
+        self.assertEqual(list(warnings.filters), filters)
+
+
+class checkCarbonateSystem(unittest.TestCase):
+    """
+    Test carbonate system speciation for all pairs of inputs.
+    """
+
+    def test_pairs(self):
+        rng = np.random.default_rng(32)
+        n = 1000
+        conditions = {
+            'temp_c': rng.uniform(0, 30, n),
+            'sal': rng.uniform(32, 38, n),
+            'p_bar': rng.uniform(0, 300, n),
+            'phosphate': rng.uniform(0, 2e-6, n),
+            'silicate': rng.uniform(0, 1e-5, n),
+        }
+        DIC = rng.uniform(1.8e-3, 2.3e-3, n)
+        ALK = DIC + rng.uniform(1e-4, 4e-4, n)
+
+        Ks = calc_Ks(K_list=CARBONATE_KS, temp_c=conditions['temp_c'], sal=conditions['sal'], p_bar=conditions['p_bar'])
+        ref = calc_carbonate_system(DIC=DIC, ALK=ALK, Ks=Ks, **conditions)
+
+        np.testing.assert_allclose(ref['ALK'], ALK, rtol=1e-12)
+        np.testing.assert_allclose(ref['CO2'] + ref['HCO3'] + ref['CO3'], DIC, rtol=1e-12)
+        self.assertTrue(np.all((ref['pH'] > 7) & (ref['pH'] < 9)))
+
+        for pair in [('pH', 'ALK'), ('pH', 'DIC'), ('pH', 'pCO2'), ('DIC', 'pCO2'), ('ALK', 'pCO2')]:
+            out = calc_carbonate_system(**{k: ref[k] for k in pair}, Ks=Ks, **conditions)
+            for k in ['pH', 'DIC', 'ALK', 'pCO2', 'CO3', 'BOH4']:
+                np.testing.assert_allclose(out[k], ref[k], rtol=1e-9, err_msg=f'{pair}: {k}')
+
+    def test_inputs(self):
+        with self.assertRaises(ValueError):
+            calc_carbonate_system(DIC=2e-3)
+        out = calc_carbonate_system(DIC=2000e-6, ALK=2300e-6)
+        self.assertAlmostEqual(float(out['pH']), 8.05, delta=0.01)
+
+
+class checkpHScales(unittest.TestCase):
+    """
+    Test pH scale conversions.
+    """
+
+    def test_factors(self):
+        KS = calc_K('KS')
+        KF = calc_K('KF')
+        factors = calc_pH_scale_factors(KS, KF, calc_sulphate(35.), calc_fluorine(35.), temp_c=25., sal=35.)
+
+        # pH_free is ~0.11 above pH_total, and pH_seawater ~0.01 below
+        self.assertAlmostEqual(convert_pH_scale(8., factors, 'total', 'free'), 8.11, delta=0.01)
+        self.assertAlmostEqual(convert_pH_scale(8., factors, 'total', 'seawater'), 7.99, delta=0.005)
+        for scale in factors:
+            self.assertAlmostEqual(convert_pH_scale(convert_pH_scale(8., factors, 'total', scale), factors, scale, 'total'), 8., places=12)
+
+        with self.assertRaises(ValueError):
+            convert_pH_scale(8., factors, 'total', 'unknown')
+
+    def test_calc_Ks(self):
+        temp_c = np.array([2., 15., 28.])
+        p_bar = np.array([0., 200., 400.])
+        total = calc_Ks(temp_c=temp_c, sal=35., p_bar=p_bar)
+        KS, KF = K_fns['KS'](K_coefs['KS'], temp_c, 35.), K_fns['KF'](K_coefs['KF'], temp_c, 35.)
+        KS = KS * calc_pressure_correction(K_presscorr_coefs['KS'], p_bar=p_bar, temp_c=temp_c)
+        KF = KF * calc_pressure_correction(K_presscorr_coefs['KF'], p_bar=p_bar, temp_c=temp_c)
+        factors = calc_pH_scale_factors(KS, KF, calc_sulphate(35.), calc_fluorine(35.), temp_c=temp_c, sal=35.)
+
+        for scale in ['free', 'seawater', 'NBS']:
+            Ks = calc_Ks(temp_c=temp_c, sal=35., p_bar=p_bar, pH_scale=scale)
+            ref = convert_K_scale(total, factors, 'total', scale)
+            for k in total:
+                np.testing.assert_allclose(Ks[k], ref[k], rtol=1e-12, err_msg=f'{scale}: {k}')
+                if k not in SCALE_DEPENDENT_KS:
+                    np.testing.assert_array_equal(Ks[k], total[k])
+            np.testing.assert_allclose(calc_K('K1', temp_c=temp_c, sal=35., p_bar=p_bar, pH_scale=scale), Ks['K1'], rtol=1e-12)
+
+        with self.assertRaises(ValueError):
+            calc_Ks(pH_scale='unknown')
+
+class checkArrayBackends(unittest.TestCase):
+    """
+    Test that Ks calculated with JAX and PyTorch arrays match NumPy.
+    """
+
+    def setUp(self):
+        self.temp_c = np.array([2., 15., 28.])
+        self.sal = np.array([30., 35., 38.])
+        self.p_bar = np.array([0., 200., 400.])
+        self.ref = calc_Ks(temp_c=self.temp_c, sal=self.sal, p_bar=self.p_bar, pH_scale='free')
+
+    @unittest.skipIf(jax is None, 'jax is not installed')
+    def test_jax(self):
+        with enable_x64():
+            calc = jax.jit(lambda t, s, p: calc_Ks(temp_c=t, sal=s, p_bar=p, pH_scale='free'))
+            Ks = calc(jnp.asarray(self.temp_c), jnp.asarray(self.sal), jnp.asarray(self.p_bar))
+            for k in self.ref:
+                self.assertIsInstance(Ks[k], jax.Array)
+                np.testing.assert_allclose(np.asarray(Ks[k]), self.ref[k], rtol=1e-12, err_msg=k)
+
+            # gradients match the analytic Jacobian
+            _, jacobian = calc_Ks_jacobian(K_list=['K1'], temp_c=15., sal=35., p_bar=200.)
+            dK1 = jax.grad(lambda t: calc_Ks(K_list=['K1'], temp_c=t, sal=35., p_bar=200.)['K1'])(jnp.asarray(15.))
+            self.assertAlmostEqual(float(dK1) / jacobian['K1']['temp_c'], 1., places=10)
+
+            # seawater corrections are calculated with NumPy and converted
+            Ks = calc_Ks(temp_c=jnp.asarray(self.temp_c), sal=jnp.asarray(self.sal), magnesium=0.04, MyAMI_mode='approximate')
+            ref = calc_Ks(temp_c=self.temp_c, sal=self.sal, magnesium=0.04, MyAMI_mode='approximate')
+            for k in ref:
+                np.testing.assert_allclose(np.asarray(Ks[k]), ref[k], rtol=1e-12, err_msg=k)
+
+    @unittest.skipIf(torch is None, 'torch is not installed')
+    def test_torch(self):
+        Ks = calc_Ks(temp_c=torch.tensor(self.temp_c), sal=torch.tensor(self.sal), p_bar=torch.tensor(self.p_bar), pH_scale='free')
+        for k in self.ref:
+            self.assertIsInstance(Ks[k], torch.Tensor)
+            np.testing.assert_allclose(Ks[k].numpy(), self.ref[k], rtol=1e-12, err_msg=k)
+
+        temp_c = torch.tensor(15., dtype=torch.float64, requires_grad=True)
+        calc_Ks(K_list=['K1'], temp_c=temp_c, sal=35., p_bar=200.)['K1'].backward()
+        _, jacobian = calc_Ks_jacobian(K_list=['K1'], temp_c=15., sal=35., p_bar=200.)
+        self.assertAlmostEqual(temp_c.grad.item() / jacobian['K1']['temp_c'], 1., places=10)
+
+class checkMemory(unittest.TestCase):
+    """
+    Test the peak memory used by the K functions and calc_Ks.
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.temp_c = rng.uniform(0, 30, (100, 1000))
+        self.sal = rng.uniform(30, 40, 1000)
+        self.p_bar = rng.uniform(0, 500, (100, 1))
+        self.array_bytes = self.temp_c.nbytes
+
+    def peak_memory(self, fn, *args, **kwargs):
+        tracemalloc.start()
+        try:
+            out = fn(*args, **kwargs)
+            return out, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_peak_memory(self):
+        for k, fn in K_fns.items():
+            _, peak = self.peak_memory(fn, K_coefs[k], self.temp_c, self.sal)
+            self.assertLess(peak, 6.5 * self.array_bytes, msg=k)
+
+        Ks, peak = self.peak_memory(calc_Ks, temp_c=self.temp_c, sal=self.sal, p_bar=self.p_bar, pH_scale='NBS')
+        self.assertLess(peak, (len(Ks) + 12) * self.array_bytes)
+
+    def test_max_memory(self):
+        for kwargs in [{}, {'K_list': ['K1', 'KS'], 'pH_scale': 'NBS'}, {'magnesium': 0.04, 'MyAMI_mode': 'approximate'}]:
+            ref = calc_Ks(temp_c=self.temp_c, sal=self.sal, p_bar=self.p_bar, **kwargs)
+            max_memory = len(ref) * self.array_bytes + 2 * 2**20
+            Ks, peak = self.peak_memory(calc_Ks, temp_c=self.temp_c, sal=self.sal, p_bar=self.p_bar, max_memory=max_memory, **kwargs)
+            self.assertLessEqual(peak, max_memory)
+            for k in ref:
+                self.assertEqual(Ks[k].shape, ref[k].shape)
+                # the MyAMI approximation is only reproducible to ~1e-10 between batches
+                np.testing.assert_allclose(Ks[k], ref[k], rtol=1e-8 if 'magnesium' in kwargs else 1e-14, err_msg=k)
+
+        with self.assertRaises(ValueError):
+            calc_Ks(temp_c=self.temp_c, sal=self.sal, max_memory=self.array_bytes)
+
+class checkSurrogate(unittest.TestCase):
+    """
+    Test the piecewise Chebyshev surrogate of calc_Ks.
+    """
+
+    def setUp(self):
+        self.surrogate = fit_surrogate({'temp_c': (0., 30.), 'sal': (30., 40.), 'p_bar': (0., 500.)}, degree=6, pieces={'temp_c': 2})
+
+    def test_accuracy(self):
+        rng = np.random.default_rng(1)
+        temp_c, sal, p_bar = rng.uniform(0, 30, 1000), rng.uniform(30, 40, 1000), rng.uniform(0, 500, 1000)
+        Ks = self.surrogate(temp_c=temp_c, sal=sal, p_bar=p_bar)
+        ref = calc_Ks(temp_c=temp_c, sal=sal, p_bar=p_bar)
+        for k in ref:
+            self.assertLess(self.surrogate.max_rel_error[k], 1e-7)
+            np.testing.assert_allclose(Ks[k], ref[k], rtol=2 * self.surrogate.max_rel_error[k], err_msg=k)
+
+        # the domain bounds and the edges between pieces are included
+        Ks = self.surrogate(temp_c=np.array([0., 15., 30.]), sal=40., p_bar=0.)
+        self.assertEqual(Ks['K1'].shape, (3,))
+
+    def test_seawater(self):
+        surrogate = fit_surrogate({'temp_c': (0., 30.), 'magnesium': (0.03, 0.06)}, K_list=['K1', 'KspC'], MyAMI_mode='approximate')
+        temp_c, magnesium = np.array([5., 25.]), np.array([0.035, 0.055])
+        Ks = surrogate(temp_c=temp_c, magnesium=magnesium)
+        ref = calc_Ks(K_list=['K1', 'KspC'], temp_c=temp_c, magnesium=magnesium, MyAMI_mode='approximate')
+        for k in ref:
+            np.testing.assert_allclose(Ks[k], ref[k], rtol=2 * surrogate.max_rel_error[k], err_msg=k)
+
+    def test_domain(self):
+        for kwargs in [{'temp_c': 31.}, {'sal': np.array([35., 29.])}, {'p_bar': np.nan}, {'magnesium': 0.04}]:
+            with self.assertRaises(ValueError):
+                self.surrogate(**kwargs)
+
+        with self.assertRaises(ValueError):
+            fit_surrogate({'depth': (0, 100)})
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'surrogate.npz')
+            self.surrogate.save(path)
+            self.assertLess(os.path.getsize(path), 50000)
+            surrogate = load_surrogate(path)
+
+        self.assertEqual(surrogate.max_rel_error, self.surrogate.max_rel_error)
+        self.assertEqual(surrogate.domain, self.surrogate.domain)
+        Ks = surrogate(temp_c=12., sal=34., p_bar=100.)
+        ref = self.surrogate(temp_c=12., sal=34., p_bar=100.)
+        for k in ref:
+            np.testing.assert_array_equal(Ks[k], ref[k])
+
+        
+class checkCoefficientSets(unittest.TestCase):
+    """
+    Test evaluating several coefficient sets in one calc_Ks call.
+    """
+
+    def setUp(self):
+        K1 = list(K_coefs['K1'])
+        K1[0] += 0.01
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'K_calculation.json')
+            with open(path, 'w') as f:
+                json.dump({'info': 'perturbed K1 and KS', 'coefficients': {'K1': K1, 'KS': [c * 1.001 for c in K_coefs['KS']]}}, f)
+            register_coefficient_set('test_perturbed', K_calculation=path, K_pressure_correction={'K2': [-16.0, 0.01, 0., -0.002, 0.]})
+
+        self.temp_c = np.linspace(0, 30, 6)
+        self.p_bar = np.linspace(0, 500, 6)
+
+    def tearDown(self):
+        coefficient_sets.pop('test_perturbed')
+
+    def test_ensemble(self):
+        for pH_scale in ['total', 'free']:
+            Ks = calc_Ks(temp_c=self.temp_c, p_bar=self.p_bar, magnesium=0.05, MyAMI_mode='approximate', pH_scale=pH_scale, coefficient_sets=['default', 'test_perturbed'])
+            for i, name in enumerate(['default', 'test_perturbed']):
+                ref = calc_Ks(temp_c=self.temp_c, p_bar=self.p_bar, magnesium=0.05, MyAMI_mode='approximate', pH_scale=pH_scale, coefficient_sets=name)
+                for k in ref:
+                    self.assertEqual(Ks[k].shape, (2, 6))
+                    np.testing.assert_allclose(Ks[k][i], ref[k], rtol=1e-12, err_msg=f'{name} {k}')
+
+        # the default set is unchanged, and only the perturbed Ks differ
+        np.testing.assert_array_equal(Ks['K1'][0], calc_Ks(K_list=['K1'], temp_c=self.temp_c, p_bar=self.p_bar, magnesium=0.05, MyAMI_mode='approximate', pH_scale='free')['K1'])
+        self.assertTrue(np.all(Ks['K1'][0] != Ks['K1'][1]))
+
+        # at the surface, only Ks with perturbed coefficients differ
+        Ks = calc_Ks(K_list=['K1', 'KspC'], temp_c=self.temp_c, coefficient_sets=['default', 'test_perturbed', 'default'])
+        self.assertEqual(Ks['KspC'].shape, (3, 6))
+        np.testing.assert_array_equal(Ks['KspC'][0], Ks['KspC'][1])
+        np.testing.assert_array_equal(Ks['K1'][0], Ks['K1'][2])
+        self.assertEqual(calc_K('K1', coefficient_sets=['default', 'test_perturbed']).shape, (2,))
+
+    def test_max_memory(self):
+        temp_c, p_bar = np.linspace(0, 30, 2000), np.linspace(0, 500, 2000)
+        Ks = calc_Ks(temp_c=temp_c, p_bar=p_bar, coefficient_sets=['default', 'test_perturbed'], max_memory=2**19)
+        ref = calc_Ks(temp_c=temp_c, p_bar=p_bar, coefficient_sets=['default', 'test_perturbed'])
+        for k in ref:
+            self.assertEqual(Ks[k].shape, (2, 2000))
+            np.testing.assert_allclose(Ks[k], ref[k], rtol=1e-12, err_msg=k)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            calc_Ks(coefficient_sets=['default', 'unknown'])
+        with self.assertRaises(ValueError):
+            register_coefficient_set('test_invalid', K_calculation={'K1': [1., 2.]})
+        with self.assertRaises(ValueError):
+            register_coefficient_set('test_invalid', K_pressure_correction={'K9': [0., 0., 0., 0., 0.]})
+        self.assertNotIn('test_invalid', coefficient_sets)
+
         
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file